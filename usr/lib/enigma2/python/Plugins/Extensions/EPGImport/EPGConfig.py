@@ -3,25 +3,40 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 from gzip import GzipFile
+from hashlib import md5
 import lzma
-from os import fstat, listdir, remove
-from os.path import exists, getmtime, join, split
+from os import fstat, listdir, makedirs, remove, rename
+from os.path import exists, getmtime, getsize, isdir, join, split
 from pickle import dump, load, HIGHEST_PROTOCOL
 from random import choice
 from time import time
 from xml.etree.cElementTree import iterparse
 from zipfile import ZipFile
 from re import compile
-from collections import defaultdict
+from collections import OrderedDict
 
 from . import log
 from .filterCustomChannel import filterCustomChannel
 
 # User selection stored here, so it goes into a user settings backup
 SETTINGS_FILE = "/etc/enigma2/epgimport.conf"
+CHANNEL_ID_FILTER_FILE = "/etc/epgimport/channel_id_filter.conf"
+# Parsed channel files, so unchanged files need not be parsed and filtered
+# again. Kept next to the downloads, one file per channel file.
+CHANNEL_CACHE_DIRNAME = "epgimport-channels"
+# Total bytes of the parsed channel files kept
+CHANNEL_CACHE_SIZE = 16 * 1024 * 1024
+CHANNEL_CACHE_VERSION = 3
 
 channelCache = {}
 global filterCustomChannel
+# Set by the plugin to a function that returns a string describing everything
+# the verdicts of the channel filter depend on. Without it parsed channel
+# files are not cached.
+channelFilterSignature = None
+# Set by the importer to a directory on persistent storage. Without it parsed
+# channel files are not cached.
+channelCacheDirectory = None
 
 
 try:
@@ -53,6 +68,64 @@ def getChannels(path, name, offset):
 	return c
 
 
+def channelCacheKey(filename, filterEnabled):
+	"""Returns the cache key of the mapping parsed from filename, None when
+	the mapping must not be cached"""
+	if channelFilterSignature is None or channelCacheDirectory is None:
+		return None
+	try:
+		digest = md5()
+		with open(filename, "rb") as f:
+			for block in iter(lambda: f.read(65536), b""):
+				digest.update(block)
+		try:
+			filterMtime = getmtime(CHANNEL_ID_FILTER_FILE)
+		except OSError:
+			filterMtime = None
+		digest.update(repr((CHANNEL_CACHE_VERSION, filterEnabled, filterMtime, channelFilterSignature())).encode())
+		return digest.hexdigest()
+	except Exception as e:
+		print("[EPGImport] channelCacheKey failed for", filename, "Error:", e, file=log)
+		return None
+
+
+def channelCacheFile(name):
+	"""The cache file of the channel file name, a new mapping of the same
+	channel file replaces the previous one"""
+	return join(channelCacheDirectory, md5(name.encode("utf-8")).hexdigest() + ".channels")
+
+
+def loadChannelCache(name, key):
+	try:
+		with open(channelCacheFile(name), "rb") as f:
+			if load(f) == key:
+				return load(f)
+	except Exception:
+		pass
+	return None
+
+
+def storeChannelCache(name, key, items):
+	try:
+		if not isdir(channelCacheDirectory):
+			makedirs(channelCacheDirectory)
+		filename = channelCacheFile(name)
+		with open(filename + ".tmp", "wb") as f:
+			dump(key, f, HIGHEST_PROTOCOL)
+			dump(items, f, HIGHEST_PROTOCOL)
+		rename(filename + ".tmp", filename)
+		# drop the least recently stored files beyond the size limit, the
+		# one just stored is kept
+		files = sorted((join(channelCacheDirectory, x) for x in listdir(channelCacheDirectory) if x.endswith(".channels")), key=getmtime, reverse=True)
+		size = getsize(filename)
+		for filename in files[1:]:
+			size += getsize(filename)
+			if size > CHANNEL_CACHE_SIZE:
+				remove(filename)
+	except Exception as e:
+		print("[EPGImport] Failed to store channel cache:", e, file=log)
+
+
 """
 elem.clear()
 When you parse an XML file with iterparse(),
@@ -66,7 +139,7 @@ which can consume a lot of RAM, especially with large files.
 def set_channel_id_filter():
 	full_filter = ""
 	try:
-		with open("/etc/epgimport/channel_id_filter.conf", "r") as channel_id_file:
+		with open(CHANNEL_ID_FILTER_FILE, "r") as channel_id_file:
 			for channel_id_line in channel_id_file:
 				# Skipping comments in channel_id_filter.conf
 				if not channel_id_line.startswith("#"):
@@ -106,12 +179,40 @@ def set_channel_id_filter():
 	return (compiled_filter)
 
 
+class ChannelMap:
+	"""Builds the channel id -> service refs mapping. The refs of a channel id
+	are kept in an OrderedDict used as ordered set, so adding and removing a
+	ref is O(1) and the refs keep the order of the channels file."""
+
+	def __init__(self):
+		self.refs = {}
+
+	def add(self, channel_id, ref):
+		refs = self.refs.get(channel_id)
+		if refs is None:
+			refs = self.refs[channel_id] = OrderedDict()
+		refs[ref] = None
+
+	def discard(self, channel_id, ref):
+		refs = self.refs.get(channel_id)
+		if refs is not None and ref in refs:
+			del refs[ref]
+			if not refs:
+				del self.refs[channel_id]
+
+	def mapping(self):
+		"""Returns a dict of channel id -> list of service refs, the form
+		XMLTVConverter and importEvents work with"""
+		return dict((channel_id, list(refs)) for channel_id, refs in self.refs.items())
+
+
 class EPGChannel:
 	def __init__(self, filename, urls=None, offset=0):
 		self.mtime = None
 		self.name = filename
 		self.urls = [filename] if urls is None else urls
-		self.items = defaultdict(set)
+		# channel id -> list of service refs, see ChannelMap
+		self.items = {}
 		self.offset = offset
 
 	def openStream(self, filename):
@@ -128,10 +229,20 @@ class EPGChannel:
 			fd = BytesIO(zip_obj.open(zip_obj.namelist()[0]).read())
 		return fd
 
-	def parse(self, filterCallback, downloadedFile, FilterChannelEnabled):
+	def parse(self, filterCallback, downloadedFile, FilterChannelEnabled, cacheName=None):
 		print("[EPGImport] Parsing channels from '%s'" % self.name, file=log)
+		if cacheName is None:
+			cacheName = self.name
+		key = channelCacheKey(downloadedFile, FilterChannelEnabled)
+		if key is not None:
+			items = loadChannelCache(cacheName, key)
+			if items is not None:
+				print("[EPGImport] Loaded %d channels of '%s' from cache" % (len(items), downloadedFile), file=log)
+				self.items = items
+				return
 		channel_id_filter = set_channel_id_filter()
-		self.items = defaultdict(set)
+		self.items = {}
+		channels = ChannelMap()
 
 		try:
 			stream = self.openStream(downloadedFile)
@@ -156,21 +267,15 @@ class EPGChannel:
 						if filter_result and FilterChannelEnabled:
 							if filter_result.group():
 								print("[EPGImport] INFO: Skipping", filter_result.group(), "due to channel_id_filter.conf", file=log)
-							try:
-								if channel_id in self.items and ref in self.items[channel_id]:
-									self.items[channel_id] = list(dict.fromkeys(self.items[channel_id]))
-									self.items[channel_id].remove(ref)
-							except Exception as e:
-								print("[EPGImport] ERROR: Failed to remove ref:", ref, "from", self.items[channel_id], "Error:", e, file=log)
+							channels.discard(channel_id, ref)
 						else:
 							if ref and filterCallback(ref):
-								if channel_id in self.items:
-									self.items[channel_id].append(ref)
-									self.items[channel_id] = list(dict.fromkeys(self.items[channel_id]))  # Ensure uniqueness
-								else:
-									self.items[channel_id] = [ref]
+								channels.add(channel_id, ref)
 
 						elem.clear()
+				self.items = channels.mapping()
+				if key is not None:
+					storeChannelCache(cacheName, key, self.items)
 		except Exception as e:
 			print("[EPGImport] ERROR: Failed to parse", downloadedFile, "Error:", e, file=log)
 			import traceback
@@ -185,7 +290,7 @@ class EPGChannel:
 
 		if exists(customFile):
 			print("[EPGImport] Parsing channels from '%s'" % customFile, file=log)
-			self.parse(filterCallback, customFile, filterCustomChannel)
+			self.parse(filterCallback, customFile, filterCustomChannel, customFile)
 		if downloadedFile is not None:
 			self.mtime = time()
 			return self.parse(filterCallback, downloadedFile, True)
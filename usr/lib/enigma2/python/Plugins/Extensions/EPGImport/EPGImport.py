@@ -6,13 +6,22 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 from . import log
+from . import eventcache
+from . import EPGConfig
+from .downloadcache import onVolatileStorage
+from .xmltvconverter import ParserPool
 
 import gzip
+import zlib
+from array import array
+from bisect import bisect_left
+from hashlib import md5
 from random import choice
 
 from os import statvfs, symlink, unlink
-from os.path import exists, getsize, join, splitext
+from os.path import exists, getmtime, getsize, join, splitext
 from requests import packages, Session
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError, RequestException
 # from secrets import choice
 from string import ascii_lowercase
@@ -46,41 +55,305 @@ else:
 PARSERS = {"xmltv": "gen_xmltv", "genxmltv": "gen_xmltv"}
 
 
-def threadGetPage(url=None, file=None, urlheaders=None, success=None, fail=None, *args, **kwargs):
+# Size of the buffer used to stream downloads to disk, this caps the memory
+# used by a download no matter how large the XMLTV file is.
+DOWNLOAD_CHUNK_SIZE = 65536
+DOWNLOAD_HEADERS = {
+	"User-Agent": "Twisted Client",
+	"Accept-Encoding": "gzip, deflate",
+	"Accept": "*/*",
+	"Connection": "keep-alive"}
+
+
+# Number of hosts the shared session keeps connections for
+HTTP_POOL_SIZE = 10
+# Minimum number of connections to the same host, further downloads wait.
+# An import run allows one more than it has prefetch workers, so the
+# current source never waits for prefetched ones from the same mirror.
+HTTP_HOST_CONNECTIONS = 2
+
+
+def createSession(poolSize=HTTP_POOL_SIZE, hostConnections=HTTP_HOST_CONNECTIONS):
+	"""Returns a session with keep-alive connection pools, meant to be shared
+	by all downloads of an import run"""
+	s = Session()
+	s.headers = {}
+	adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=hostConnections, pool_block=True)
+	s.mount("http://", adapter)
+	s.mount("https://", adapter)
+	return s
+
+
+def sessionStatistics(s):
+	"""Returns the number of requests and of opened connections of session s"""
+	requests = connections = 0
+	for adapter in s.adapters.values():
+		try:
+			pools = adapter.poolmanager.pools
+			for key in pools.keys():
+				pool = pools[key]
+				requests += pool.num_requests
+				connections += pool.num_connections
+		except Exception as e:
+			print("[EPGImport][sessionStatistics] error:", e, file=log)
+	return requests, connections
+
+
+# Number of times an interrupted download is continued with a Range request
+DOWNLOAD_RESUME_ATTEMPTS = 3
+
+
+def threadWriteBody(s, url, urlheaders, response, f):
+	"""Writes the body of response to the open file f and returns its size.
+	When the transfer breaks off and the server accepts byte ranges, the
+	download is continued where it stopped instead of starting over. The
+	size is checked against the size announced by the server. Raises
+	RequestException when the body could not be completed."""
+	# With a Content-Encoding the announced size and the byte ranges refer
+	# to the encoded data, not to what iter_content gives us.
+	encoded = response.headers.get("Content-Encoding", "identity").lower() != "identity"
+	resumable = not encoded and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+	expected = None if encoded else response.headers.get("Content-Length")
+	expected = int(expected) if expected and expected.isdigit() else None
+	# If-Range makes the server send the whole file again when it changed meanwhile
+	validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+	size = 0
+	attempt = 0
+	while True:
+		error = None
+		try:
+			for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+				if chunk:
+					f.write(chunk)
+					size += len(chunk)
+		except RequestException as e:
+			error = e
+		finally:
+			response.close()
+		if error is None and (expected is None or size >= expected):
+			break
+		if not resumable or attempt >= DOWNLOAD_RESUME_ATTEMPTS:
+			raise error or RequestException("Incomplete download, %d of %d bytes" % (size, expected))
+		attempt += 1
+		print("[EPGImport][threadWriteBody] Download interrupted at %d bytes (%s), resuming" % (size, error), file=log)
+		headers = dict(urlheaders or {}, Range="bytes=%d-" % size)
+		if validator:
+			headers["If-Range"] = validator
+		response = s.get(url, verify=False, headers=headers, timeout=15, allow_redirects=True, stream=True)
+		if response.status_code == 206 and response.headers.get("Content-Range", "").startswith("bytes %d-" % size):
+			continue
+		response.raise_for_status()
+		if response.status_code != 200:
+			response.close()
+			raise RequestException("Unexpected reply to resuming at %d bytes: %s %s" % (size, response.status_code, response.headers.get("Content-Range")))
+		# the file changed or the range was ignored, start over
+		print("[EPGImport][threadWriteBody] Server sent the whole file again", file=log)
+		f.seek(0)
+		f.truncate()
+		size = 0
+		encoded = response.headers.get("Content-Encoding", "identity").lower() != "identity"
+		resumable = not encoded and response.headers.get("Accept-Ranges", "").lower() == "bytes"
+		expected = None if encoded else response.headers.get("Content-Length")
+		expected = int(expected) if expected and expected.isdigit() else None
+		validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+	if expected is not None and size != expected:
+		raise RequestException("Download size mismatch, %d instead of %d bytes" % (size, expected))
+	return size
+
+
+def threadGetPage(url=None, file=None, urlheaders=None, success=None, fail=None, cache=None, notModified=None, stats=None, session=None, *args, **kwargs):
 	# print("[EPGImport][threadGetPage] url, file, args, kwargs", url, "   ", file, "	", args, "	 ", kwargs)
 	try:
-		s = Session()
-		s.headers = {}
-		response = s.get(url, verify=False, headers=urlheaders, timeout=15, allow_redirects=True)
-		response.raise_for_status()
-		# check here for content-disposition header so to extract the actual filename (if the url doesnt contain it)
-		content_disp = response.headers.get("Content-Disposition", "")
-		filename = content_disp.split('filename="')[-1].split('"')[0]
-		ext = splitext(file)[1]
-		if filename:
-			ext = splitext(filename)[1]
-			if ext and len(ext) < 6:
-				file += ext
-		if not ext:
-			ext = splitext(response.url)[1]
-			if ext and len(ext) < 6:
-				file += ext
-
-		with open(file, "wb") as f:
-			f.write(response.content)
+		s = session or createSession()
+		if cache is not None:
+			urlheaders = dict(urlheaders, **cache.conditionalHeaders(url, withoutFile=notModified is not None))
+		begin = time()
+		response = s.get(url, verify=False, headers=urlheaders, timeout=15, allow_redirects=True, stream=True)
+		latency = time() - begin
+		try:
+			if cache is not None and response.status_code == 304:
+				print("[EPGImport][threadGetPage] Not modified:", url, file=log)
+				if stats is not None:
+					stats.recordLatency(url, latency)
+				cached = cache.notModified(url)
+				if notModified is not None:
+					notModified(cached)
+				elif cached:
+					success(cached, deleteFile=False)
+				else:
+					fail("Not modified, but no cached file")
+				return
+			response.raise_for_status()
+			# check here for content-disposition header so to extract the actual filename (if the url doesnt contain it)
+			content_disp = response.headers.get("Content-Disposition", "")
+			filename = content_disp.split('filename="')[-1].split('"')[0]
+			ext = splitext(file)[1]
+			if filename:
+				ext = splitext(filename)[1]
+				if ext and len(ext) < 6:
+					file += ext
+			if not ext:
+				ext = splitext(response.url)[1]
+				if ext and len(ext) < 6:
+					file += ext
+
+			# write the body as it arrives instead of holding response.content in memory
+			with open(file, "wb") as f:
+				size = threadWriteBody(s, url, urlheaders, response, f)
+		finally:
+			response.close()
+		elapsed = max(time() - begin, 0.001)
+		print("[EPGImport][threadGetPage] Downloaded %d bytes in %.1fs (%d bytes/sec) from %s" % (size, elapsed, size / elapsed, url), file=log)
+		if stats is not None:
+			stats.record(url, latency, size, elapsed)
 		# print("[EPGImport][threadGetPage] file completed: ", file)
-		success(file, deleteFile=True)
+		cached = cache is not None and cache.store(url, response.headers, file)
+		if cached:
+			success(cached, deleteFile=False)
+		else:
+			success(file, deleteFile=True)
 
 	except HTTPError as httperror:
 		print("EPGImport][threadGetPage] Http error: ", httperror)
+		if stats is not None:
+			stats.recordFailure(url)
+		if exists(file):
+			unlink_if_exists(file)
 		fail(httperror)	 # E0602 undefined name "error"
 
 	except RequestException as error:
 		print("[EPGImport][threadGetPage] error: ", error)
+		if stats is not None:
+			stats.recordFailure(url)
+		if exists(file):
+			# do not leave an incomplete download behind
+			unlink_if_exists(file)
 		# if fail is not None:
 		fail(error)
 
 
+class DecompressingReader:
+	"""Read-only file object over an HTTP response body that uncompresses
+	gzip and xz data on the fly, so it can be handed to the XMLTV parser
+	without storing the download first. The compression type is detected
+	from the first bytes of the body."""
+
+	def __init__(self, response, url, stats=None, latency=0):
+		self.response = response
+		self.url = url
+		self.stats = stats
+		self.latency = latency
+		self.chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+		self.buffer = bytearray()
+		self.decompressor = None
+		self.newDecompressor = None
+		self.detected = False
+		self.eof = False
+		# the exception that broke off the stream, the parser swallows it
+		self.error = None
+		self.size = 0
+		self.begin = time()
+
+	def createDecompressor(self, data):
+		if data.startswith(b"\x1f\x8b"):
+			print("[EPGImport][DecompressingReader] gzip stream from", self.url, file=log)
+			self.newDecompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+		elif data.startswith(b"\xfd7zXZ\x00") or data.startswith(b"\x5d\x00\x00"):
+			try:
+				import lzma
+			except ImportError:
+				from backports import lzma
+			print("[EPGImport][DecompressingReader] xz stream from", self.url, file=log)
+			self.newDecompressor = lzma.LZMADecompressor
+		else:
+			self.newDecompressor = None
+			return None
+		return self.newDecompressor()
+
+	def decompress(self, data):
+		if not self.detected:
+			self.detected = True
+			self.decompressor = self.createDecompressor(data)
+		if self.decompressor is None:
+			return data
+		result = self.decompressor.decompress(data)
+		# concatenated gzip members or xz streams
+		while self.decompressor.unused_data:
+			data = self.decompressor.unused_data
+			self.decompressor = self.newDecompressor()
+			result += self.decompressor.decompress(data)
+		return result
+
+	def read(self, size=-1):
+		try:
+			return self.readBuffered(size)
+		except Exception as e:
+			print("[EPGImport][DecompressingReader] Stream from %s broke off:" % self.url, e, file=log)
+			if self.stats is not None:
+				self.stats.recordFailure(self.url)
+			self.error = e
+			raise
+
+	def readBuffered(self, size):
+		buffer = self.buffer
+		while not self.eof and (size < 0 or len(buffer) < size):
+			try:
+				chunk = next(self.chunks)
+			except StopIteration:
+				if self.decompressor is not None and hasattr(self.decompressor, "flush"):
+					buffer += self.decompressor.flush()
+				if not getattr(self.decompressor, "eof", True):
+					raise RequestException("Compressed stream ends early after %d bytes" % self.size)
+				self.eof = True
+				elapsed = max(time() - self.begin, 0.001)
+				print("[EPGImport][DecompressingReader] Streamed %d bytes in %.1fs (%d bytes/sec) from %s" % (self.size, elapsed, self.size / elapsed, self.url), file=log)
+				if self.stats is not None:
+					self.stats.record(self.url, self.latency, self.size, elapsed)
+				break
+			if chunk:
+				self.size += len(chunk)
+				buffer += self.decompress(chunk)
+		if size < 0 or size >= len(buffer):
+			data = bytes(buffer)
+			del buffer[:]
+		else:
+			data = bytes(buffer[:size])
+			del buffer[:size]
+		return data
+
+	def fileno(self):
+		return None
+
+	def close(self):
+		self.response.close()
+
+
+def threadOpenStream(url=None, urlheaders=None, cache=None, stats=None, session=None):
+	"""Opens url and returns a DecompressingReader over its body, raises
+	RequestException when the server cannot be reached or answers with an
+	error. Returns None when cache is given and the server reports the
+	source as not modified. Blocks, so call it from a thread."""
+	s = session or createSession()
+	if cache is not None:
+		urlheaders = dict(urlheaders, **cache.conditionalHeaders(url, withoutFile=True))
+	begin = time()
+	try:
+		response = s.get(url, verify=False, headers=urlheaders, timeout=15, allow_redirects=True, stream=True)
+		if cache is not None and response.status_code == 304:
+			response.close()
+			return None
+		try:
+			response.raise_for_status()
+		except HTTPError:
+			response.close()
+			raise
+	except RequestException:
+		if stats is not None:
+			stats.recordFailure(url)
+		raise
+	return DecompressingReader(response, url, stats, time() - begin)
+
+
 def relImport(name):
 	fullname = __name__.split(".")
 	fullname[-1] = name
@@ -168,6 +441,199 @@ class OudeisImporter:
 				print("[EPGImport][OudeisImporter][importEvents] ### importEvents exception:", e)
 
 
+# Number of consecutive events of the same services handed to the storage
+# in one importEvents call
+IMPORT_BATCH_SIZE = 500
+# Seconds after which a partial batch is flushed anyway, so the events of a
+# slow source show up in the EPG without waiting for the batch to fill
+IMPORT_BATCH_INTERVAL = 2.0
+
+
+class EventBatch:
+	"""Collects consecutive events of the same services, so the storage gets
+	one importEvents call per batch instead of one call per event. failed is
+	called with the services and the event of every event that was lost.
+	tick is called for every item read from the source, it flushes a batch
+	that waited interval seconds also while no events are added."""
+
+	def __init__(self, storage, size=IMPORT_BATCH_SIZE, interval=IMPORT_BATCH_INTERVAL, failed=None):
+		self.storage = storage
+		self.size = max(size, 1)
+		self.interval = interval
+		self.failed = failed
+		self.services = None
+		self.events = []
+		self.started = 0
+		self.calls = 0
+
+	def add(self, services, event):
+		if services is not self.services and services != self.services:
+			self.flush()
+			self.services = services
+		events = self.events
+		if not events:
+			self.started = time()
+		events.append(event)
+		if len(events) >= self.size:
+			self.flush()
+
+	def tick(self):
+		if self.events and time() - self.started >= self.interval:
+			self.flush()
+
+	def flush(self):
+		if not self.events:
+			return
+		events = tuple(self.events)
+		self.events = []
+		self.calls += 1
+		try:
+			self.storage.importEvents(self.services, events)
+		except Exception as e:
+			# import the events one at a time, so only the bad ones are lost
+			print("[EPGImport][EventBatch] ### importEvents exception, importing %d events one at a time:" % len(events), e, file=log)
+			for event in events:
+				try:
+					self.storage.importEvents(self.services, (event,))
+				except Exception as e:
+					print("[EPGImport][EventBatch] ### importEvents exception, event lost:", e, file=log)
+					if self.failed is not None:
+						self.failed(self.services, event)
+
+
+# A skipped event is checked against the EPG cache once every this many
+# skipped events of the same services, starting with the first one
+SPOT_CHECK_INTERVAL = 100
+
+
+class EventFingerprints:
+	"""32 bit fingerprints of the events imported into the EPG cache, per
+	service list. They are kept for the lifetime of enigma2, as a sorted
+	array per service list. An event with a known fingerprint is already in
+	the EPG cache and is not imported again.
+	The EPG cache can lose events without us knowing, e.g. when they are
+	overwritten from the broadcast or the EPG is cleared. exists(services,
+	event) is asked about some of the skipped events, when one is gone the
+	events of its services are imported again and remembered only after a
+	complete import."""
+
+	def __init__(self, exists=None):
+		self.known = {}
+		self.exists = exists
+		self.begin()
+
+	def begin(self):
+		self.seen = {}
+		self.failures = {}
+		self.skips = {}
+		self.stale = set()
+		self.keys = {}
+		self.skipped = 0
+		self.changed = 0
+
+	def key(self, services):
+		# the list is kept with its key, so its id cannot be reused
+		entry = self.keys.get(id(services))
+		if entry is None:
+			entry = self.keys[id(services)] = (services, tuple(services))
+		return entry[1]
+
+	@staticmethod
+	def fingerprint(event):
+		if len(event) > 7:
+			# the parental rating is a list
+			return hash(event[:7] + tuple(event[7])) & 0xffffffff
+		return hash(event) & 0xffffffff
+
+	def unchanged(self, services, event):
+		"""Remembers event and tells whether the last import had it too"""
+		key = self.key(services)
+		fingerprint = self.fingerprint(event)
+		seen = self.seen.get(key)
+		if seen is None:
+			seen = self.seen[key] = []
+		seen.append(fingerprint)
+		known = self.known.get(key)
+		if known is not None:
+			i = bisect_left(known, fingerprint)
+			if i < len(known) and known[i] == fingerprint:
+				skips = self.skips.get(key, 0)
+				self.skips[key] = skips + 1
+				if skips % SPOT_CHECK_INTERVAL or (self.exists is not None and self.exists(services, event)):
+					self.skipped += 1
+					return True
+				print("[EPGImport][EventFingerprints] Events of %s are missing from the EPG cache, importing them again" % key[0], file=log)
+				del self.known[key]
+				if skips:
+					# events skipped before may be missing too
+					self.stale.add(key)
+		self.changed += 1
+		return False
+
+	def failed(self, services, event):
+		"""Forgets an event that could not be imported, so it is retried"""
+		key = self.key(services)
+		failures = self.failures.get(key)
+		if failures is None:
+			failures = self.failures[key] = set()
+		failures.add(self.fingerprint(event))
+
+	def commit(self):
+		"""Makes the events of this import the known events of their services"""
+		for key, seen in self.seen.items():
+			if key in self.stale:
+				self.known.pop(key, None)
+			else:
+				self.known[key] = array("I", sorted(set(seen).difference(self.failures.get(key, ()))))
+		self.begin()
+
+	def clear(self):
+		self.known = {}
+		self.begin()
+
+
+# Number of service lists of a source whose latest event is looked up in the
+# EPG cache before the unchanged source is skipped
+IMPORT_SAMPLES = 8
+
+
+class EventSamples:
+	"""The latest event of the first few service lists of a source. An
+	unchanged source is only skipped while the EPG cache still has them."""
+
+	def __init__(self, size=IMPORT_SAMPLES):
+		self.size = size
+		self.samples = []
+		self.services = None
+		self.sample = None
+
+	def add(self, services, event):
+		if services is not self.services:
+			self.services = services
+			self.sample = None
+			if len(self.samples) < self.size:
+				self.sample = [list(services), event[0]]
+				self.samples.append(self.sample)
+		elif self.sample is not None and event[0] > self.sample[1]:
+			self.sample[1] = event[0]
+
+
+# Parser options that limit the events to an import window
+WINDOW_OPTIONS = ("windowStart", "windowEnd")
+
+
+def windowEvents(iterator, windowStart=None, windowEnd=None):
+	"""Drops the events outside the import window, like the converter does"""
+	for item in iterator:
+		if item is not None:
+			event = item[1]
+			if windowStart is not None and event[0] + event[1] <= windowStart:
+				continue
+			if windowEnd is not None and event[0] >= windowEnd:
+				continue
+		yield item
+
+
 def unlink_if_exists(filename):
 	try:
 		unlink(filename)
@@ -188,6 +654,30 @@ class EPGImport:
 		self.fd = None
 		self.iterator = None
 		self.onDone = None
+		self.pipelineDownload = False
+		self.pipelineUrl = None
+		self.downloadCache = None
+		self.skipUnchanged = True
+		self.mirrorStats = None
+		self.raceMirrors = False
+		self.session = None
+		self.poolSize = HTTP_POOL_SIZE
+		self.batchSize = IMPORT_BATCH_SIZE
+		self.batch = None
+		# extra keyword arguments for the parser, e.g. the xmltv backend
+		self.parserOptions = {}
+		# parser processes kept for the whole import, see ParserPool
+		self.parserPool = None
+		# replay the events of a source file that was imported before
+		self.eventCache = False
+		self.sourceFile = None
+		# only import the events that changed since the last import
+		self.differential = False
+		self.fingerprints = None
+		self.samples = None
+		self.prefetchWorkers = 0
+		self.prefetched = {}
+		self.waitingPrefetch = None
 		self.epgcache = epgcache
 		self.channelFilter = channelFilter
 		return
@@ -205,6 +695,19 @@ class EPGImport:
 			from . import epgdat_importer
 			self.storage = epgdat_importer.epgdatclass()
 
+		self.session = createSession(self.poolSize, max(HTTP_HOST_CONNECTIONS, self.prefetchWorkers + 1))
+		EPGConfig.channelCacheDirectory = self.cacheDirectory(EPGConfig.CHANNEL_CACHE_DIRNAME)
+		if self.parserOptions.get("workers", 1) > 1:
+			self.parserPool = ParserPool(self.parserOptions["workers"])
+		if self.differential and not hasattr(self.storage, "epgfile"):
+			if self.fingerprints is None:
+				self.fingerprints = EventFingerprints(self.eventExists)
+			self.fingerprints.begin()
+			self.batch = EventBatch(self.storage, self.batchSize, failed=self.fingerprints.failed)
+		else:
+			# the EPG cache is flushed or rebuilt, forget what it had
+			self.fingerprints = None
+			self.batch = EventBatch(self.storage, self.batchSize)
 		self.eventCount = 0
 		if longDescUntil is None:
 			# default to 7 days ahead
@@ -213,6 +716,19 @@ class EPGImport:
 			self.longDescUntil = longDescUntil
 		self.nextImport()
 
+	def eventExists(self, services, event):
+		"""Tells whether the EPG cache still has event on all services"""
+		try:
+			from enigma import eServiceReference
+			for service in services:
+				found = self.epgcache.lookupEventTime(eServiceReference(service), event[0])
+				if found is None or found.getBeginTime() != event[0]:
+					return False
+		except Exception as e:
+			print("[EPGImport][eventExists] Cannot look up events:", e, file=log)
+			return False
+		return True
+
 	def nextImport(self):
 		self.closeReader()
 		if not self.sources:
@@ -222,18 +738,199 @@ class EPGImport:
 		self.source = self.sources.pop()
 
 		print("[EPGImport][nextImport], source=", self.source.description, file=log)
-		self.fetchUrl(self.source.url)
+		if self.source in self.prefetched:
+			result = self.prefetched.pop(self.source)
+			self.startPrefetch()
+			if result is None:
+				print("[EPGImport][nextImport] Waiting for prefetch of", self.source.url, file=log)
+				self.waitingPrefetch = self.source
+			else:
+				self.dispatchPrefetch(result)
+		else:
+			self.startPrefetch()
+			if self.raceMirrors and self.mirrorStats is not None and len(self.source.urls) > 1 and self.source.url.startswith(("http:", "https:")):
+				callInThread(self.threadRaceMirrors, self.source)
+			else:
+				self.selectMirror(self.source)
+				self.fetchUrl(self.source.url)
+
+	def selectMirror(self, source):
+		if self.mirrorStats is not None and len(source.urls) > 1:
+			source.url = self.mirrorStats.rank(source.urls)[0]
+		else:
+			source.url = choice(source.urls)
+
+	def threadRaceMirrors(self, source):
+		source.url = self.mirrorStats.race(source.urls, DOWNLOAD_HEADERS, self.session)
+		reactor.callFromThread(self.fetchUrl, source.url)
+
+	def canPrefetch(self, source):
+		url = source.url
+		return (
+			source.parser != "epg.dat"
+			and (url.startswith("http:") or url.startswith("https:") or url.startswith("ftp:"))
+			and not (self.pipelineDownload and twisted.python.runtime.platform.supportsThreads())
+		)
+
+	def startPrefetch(self):
+		"""Downloads the next sources in worker threads while the current one is parsed"""
+		if not self.prefetchWorkers:
+			return
+		for source in reversed(self.sources):
+			if len(self.prefetched) >= self.prefetchWorkers:
+				break
+			if source in self.prefetched:
+				continue
+			self.selectMirror(source)
+			if not self.canPrefetch(source):
+				continue
+			try:
+				# leave room for the files that are already being prefetched
+				filename = self.downloadFilename(source.url, 9000000 * (len(self.prefetched) + 2))
+			except Exception as e:
+				print("[EPGImport][startPrefetch] Not prefetching:", e, file=log)
+				break
+			print("[EPGImport][startPrefetch] Prefetching:", source.url, filename, file=log)
+			self.prefetched[source] = None
+			self.prefetchSource(source, filename)
+
+	def prefetchSource(self, source, filename):
+		# These run in the download thread, hand the results back to the reactor
+		def success(filename, deleteFile=False):
+			reactor.callFromThread(self.prefetchDone, source, (self.afterDownload, filename, deleteFile))
+
+		def fail(failure):
+			reactor.callFromThread(self.prefetchDone, source, (self.downloadFail, failure))
+
+		def notModified(filename):
+			reactor.callFromThread(self.prefetchDone, source, (self.sourceNotModified, filename))
+
+		callInThread(threadGetPage, url=source.url, file=filename, urlheaders=DOWNLOAD_HEADERS, success=success, fail=fail, cache=self.downloadCache, notModified=notModified if self.canSkipSource(source, source.url) else None, stats=self.mirrorStats, session=self.session)
+
+	def prefetchDone(self, source, result):
+		if self.waitingPrefetch is source:
+			self.waitingPrefetch = None
+			self.dispatchPrefetch(result)
+		elif source in self.prefetched:
+			self.prefetched[source] = result
+		else:
+			# import has been closed meanwhile
+			self.discardPrefetch(result)
+
+	def dispatchPrefetch(self, result):
+		callback = result[0]
+		if callback == self.afterDownload:
+			self.afterDownload(result[1], deleteFile=result[2])
+		else:
+			callback(*result[1:])
+
+	def discardPrefetch(self, result):
+		if result is not None and result[0] == self.afterDownload and result[2]:
+			unlink_if_exists(result[1])
 
 	def fetchUrl(self, filename):
-		if filename.startswith("http:") or filename.startswith("https:") or filename.startswith("ftp:"):
+		self.pipelineUrl = None
+		if self.canPipeline(filename):
+			# The source is parsed straight from the socket once the channels are known
+			print("[EPGImport][fetchUrl] Streaming without intermediate file:", filename, file=log)
+			self.pipelineUrl = filename
+			self.fetchChannels()
+		elif filename.startswith("http:") or filename.startswith("https:") or filename.startswith("ftp:"):
 			# print("[EPGImport][fetchurl] download Basic ...url filename", filename)
-			self.urlDownload(filename, self.afterDownload, self.downloadFail)
+			self.urlDownload(filename, self.afterDownload, self.downloadFail, self.sourceNotModified)
 		else:
 			self.afterDownload(filename, deleteFile=False)
 
-	def urlDownload(self, sourcefile, afterDownload, downloadFail):
-		media_path = "/media/hdd"
+	def canPipeline(self, filename):
+		return (
+			self.pipelineDownload
+			and self.source.parser != "epg.dat"
+			and (filename.startswith("http:") or filename.startswith("https:"))
+			and twisted.python.runtime.platform.supportsThreads()
+		)
+
+	def canSkipUnchanged(self):
+		# Without a patched enigma a new epg.dat is written from the imported
+		# events only, so every source must be imported again.
+		return self.downloadCache is not None and self.skipUnchanged and not hasattr(self.storage, "epgfile")
+
+	def importSignature(self, source):
+		"""Everything besides the file itself that decides which events an
+		import of source gives, None while its channel mapping is not known
+		or due to be refreshed"""
+		channels = source.channels
+		if not channels.items or channels.downloadables():
+			return None
+		options = sorted((name, value) for name, value in self.parserOptions.items() if name not in ("workers",) + WINDOW_OPTIONS)
+		signature = [sorted(channels.items.items()), source.parser, source.offset, options]
+		windowStart = self.parserOptions.get("windowStart")
+		windowEnd = self.parserOptions.get("windowEnd")
+		if windowStart is not None and windowEnd is not None:
+			signature.append(windowEnd - windowStart)
+		# channels.update parses local channel files again when they change
+		for filename in channels.urls[:1] + ["/etc/epgimport/custom.channels.xml", "/etc/epgimport/rytec.channels.xml"]:
+			if EPGConfig.isLocalFile(filename):
+				try:
+					signature.append(getmtime(filename))
+				except OSError:
+					signature.append(None)
+		if EPGConfig.channelFilterSignature is not None:
+			signature.append(EPGConfig.channelFilterSignature())
+		return md5(repr(signature).encode()).hexdigest()
+
+	def canSkipSource(self, source, url):
+		"""Tells whether source can be skipped when url did not change: its
+		current file went into the EPG completely with the same channel
+		mapping and options, and the EPG cache still has its events"""
+		if not self.canSkipUnchanged():
+			return False
+		imported = self.downloadCache.imported(url)
+		if imported is None:
+			return False
+		signature, samples, windowEnd = imported
+		if signature is None or signature != self.importSignature(source):
+			print("[EPGImport][canSkipSource] Channels or options not known or changed since the last import of", url, file=log)
+			return False
+		currentEnd = self.parserOptions.get("windowEnd")
+		if currentEnd is not None and (windowEnd is None or windowEnd < currentEnd):
+			# the import window moved on, its new days are not in the EPG yet
+			return False
+		now = time()
+		samples = [(services, begin) for services, begin in samples if begin > now]
+		if not samples:
+			return False
+		for services, begin in samples:
+			if not self.eventExists(services, (begin,)):
+				print("[EPGImport][canSkipSource] The EPG cache lost the events of", url, file=log)
+				return False
+		return True
+
+	def sourceImported(self):
+		"""Remembers that the current file of the source went into the EPG
+		completely, see canSkipSource"""
+		if self.downloadCache is not None and self.samples is not None:
+			self.downloadCache.setImported(self.source.url, (self.importSignature(self.source), self.samples.samples, self.parserOptions.get("windowEnd")))
+
+	def sourceNotModified(self, filename):
+		if self.canSkipSource(self.source, self.source.url):
+			print("[EPGImport][sourceNotModified] Source not modified since last import, skipping", self.source.description, file=log)
+			self.nextImport()
+		elif filename:
+			self.afterDownload(filename, deleteFile=False)
+		else:
+			self.downloadFail("Not modified, but no cached file")
+
+	def downloadFilename(self, sourcefile, minFree=9000000):
 		host = "".join([choice(ascii_lowercase) for i in range(5)])
+		filename = join(self.downloadDirectory(minFree), host)
+		ext = splitext(sourcefile)[1]
+		# Keep sensible extension, in particular the compression type
+		if ext and len(ext) < 6:
+			filename += ext
+		return filename
+
+	def downloadDirectory(self, minFree=9000000):
+		media_path = "/media/hdd"
 		check_mount = False
 		if exists(media_path):
 			with open("/proc/mounts", "r") as f:
@@ -244,20 +941,16 @@ class EPGImport:
 
 		# print("[EPGImport][urlDownload]2 check_mount ", check_mount)
 		pathDefault = media_path if check_mount else "/tmp"
-		path = bigStorage(9000000, pathDefault, "/media/usb", "/media/cf")  # lets use HDD and flash as main backup media
-		filename = join(path, host)
-		ext = splitext(sourcefile)[1]
-		# Keep sensible extension, in particular the compression type
-		if ext and len(ext) < 6:
-			filename += ext
-		Headers = {
-			"User-Agent": "Twisted Client",
-			"Accept-Encoding": "gzip, deflate",
-			"Accept": "*/*",
-			"Connection": "keep-alive"}
+		return bigStorage(minFree, pathDefault, "/media/usb", "/media/cf")  # lets use HDD and flash as main backup media
+
+	def urlDownload(self, sourcefile, afterDownload, downloadFail, notModified=None):
+		filename = self.downloadFilename(sourcefile)
 
 		print("[EPGImport][urlDownload] Downloading:", sourcefile, filename)
-		callInThread(threadGetPage, url=sourcefile, file=filename, urlheaders=Headers, success=afterDownload, fail=downloadFail)
+		if notModified is not None and not self.canSkipSource(self.source, sourcefile):
+			# only a cached file can be used when the server reports no changes
+			notModified = None
+		callInThread(threadGetPage, url=sourcefile, file=filename, urlheaders=DOWNLOAD_HEADERS, success=afterDownload, fail=downloadFail, cache=self.downloadCache, notModified=notModified, stats=self.mirrorStats, session=self.session)
 
 	def afterDownload(self, filename, deleteFile=False):
 		# print("[EPGImport][afterDownload] filename", filename)
@@ -317,6 +1010,10 @@ class EPGImport:
 		else:
 			self.fd = open(filename, "rb")
 
+		if self.eventCache and self.eventCacheDirectory() is not None:
+			# keep the raw file for the cache key, it may be removed below
+			self.sourceFile = open(filename, "rb")
+
 		if deleteFile and self.source.parser != "epg.dat":
 			try:
 				print("[EPGImport][afterDownload] unlink", filename, file=log)
@@ -324,6 +1021,9 @@ class EPGImport:
 			except Exception as e:
 				print("[EPGImport][afterDownload] warning: Could not remove '%s' intermediate" % filename, e, file=log)
 
+		self.fetchChannels()
+
+	def fetchChannels(self):
 		self.channelFiles = self.source.channels.downloadables()
 		if not self.channelFiles:
 			self.afterChannelDownload(None, None)
@@ -331,7 +1031,6 @@ class EPGImport:
 			filename = choice(self.channelFiles)
 			self.channelFiles.remove(filename)
 			self.urlDownload(filename, self.afterChannelDownload, self.channelDownloadFail)
-		return
 
 	def downloadFail(self, failure):
 		print("[EPGImport][downloadFail] download failed:", failure, file=log)
@@ -339,7 +1038,7 @@ class EPGImport:
 			self.source.urls.remove(self.source.url)
 		if self.source.urls:
 			print("[EPGImport][downloadFail] Attempting alternative URL", file=log)
-			self.source.url = choice(self.source.urls)
+			self.selectMirror(self.source)
 			print("[EPGImport][downloadFail] try alternative download url", self.source.url)
 			self.fetchUrl(self.source.url)
 		else:
@@ -356,7 +1055,7 @@ class EPGImport:
 				return
 		if twisted.python.runtime.platform.supportsThreads():
 			print("[EPGImport][afterChannelDownload] Using twisted thread", file=log)
-			threads.deferToThread(self.doThreadRead, filename).addCallback(lambda ignore: self.nextImport())
+			threads.deferToThread(self.doThreadRead, filename, deleteFile).addCallback(self.afterThreadRead)
 			deleteFile = False  # Thread will delete it
 		else:
 			self.iterator = self.createIterator(filename)
@@ -380,7 +1079,69 @@ class EPGImport:
 	def createIterator(self, filename):
 		# print("[EPGImport][createIterator], filename", filename)
 		self.source.channels.update(self.channelFilter, filename)
-		return getParser(self.source.parser).iterator(self.fd, self.source.channels.items, self.source.offset)
+		items = self.source.channels.items
+		self.samples = EventSamples()
+		if self.downloadCache is not None:
+			# until this import completes
+			self.downloadCache.setImported(self.source.url, None)
+		key = None
+		if self.sourceFile is not None:
+			try:
+				# the number of parse processes does not change the events and
+				# the import window is applied after recording or replaying them
+				options = sorted((name, value) for name, value in self.parserOptions.items() if name not in ("workers",) + WINDOW_OPTIONS)
+				key = eventcache.cacheKey(self.sourceFile, items, self.source.parser, self.source.offset, options)
+			except Exception as e:
+				print("[EPGImport][createIterator] Cannot use the event cache:", e, file=log)
+			self.sourceFile.close()
+			self.sourceFile = None
+		options = dict(self.parserOptions)
+		if self.parserPool is not None:
+			options["pool"] = self.parserPool
+		directory = self.eventCacheDirectory() if key is not None else None
+		if directory is None:
+			return getParser(self.source.parser).iterator(self.fd, items, self.source.offset, **options)
+		cache = eventcache.EventCache(directory)
+		events = cache.load(key)
+		if events is not None:
+			iterator = eventcache.replay(events)
+		else:
+			options = dict((name, value) for name, value in options.items() if name not in WINDOW_OPTIONS)
+			iterator = self.recordEvents(cache, key, getParser(self.source.parser).iterator(self.fd, items, self.source.offset, **options))
+		return windowEvents(iterator, self.parserOptions.get("windowStart"), self.parserOptions.get("windowEnd"))
+
+	def recordEvents(self, cache, key, iterator):
+		recorder = cache.recorder(key)
+		if recorder is None:
+			for item in iterator:
+				yield item
+			return
+		completed = False
+		try:
+			for item in recorder.record(iterator):
+				yield item
+			completed = True
+		finally:
+			if completed:
+				cache.store(key, recorder)
+			else:
+				cache.discard(recorder)
+
+	def eventCacheDirectory(self):
+		"""Directory of the event cache, None when it would be in RAM"""
+		return self.cacheDirectory(eventcache.CACHE_DIRNAME)
+
+	def cacheDirectory(self, name):
+		"""Directory name next to the downloads, None when it would be in RAM"""
+		try:
+			directory = self.downloadDirectory()
+		except Exception as e:
+			print("[EPGImport][cacheDirectory] No storage:", e, file=log)
+			return None
+		if onVolatileStorage(directory):
+			print("[EPGImport][cacheDirectory] Not caching %s in RAM, %s" % (name, directory), file=log)
+			return None
+		return join(directory, name)
 
 	def readEpgDatFile(self, filename, deleteFile=False):
 		if not hasattr(self.epgcache, 'load'):
@@ -405,6 +1166,9 @@ class EPGImport:
 
 			print("[EPGImport][readEpgDatFile] Importing", HDD_EPG_DAT, file=log)
 			self.epgcache.load()
+			if self.fingerprints is not None:
+				# load() may have replaced events imported before
+				self.fingerprints.clear()
 
 			if deleteFile:
 				unlink_if_exists(filename)
@@ -417,31 +1181,74 @@ class EPGImport:
 		else:
 			return
 
-	def doThreadRead(self, filename):
+	def doThreadRead(self, filename, deleteFile=True):
 		"""This is used on PLi with threading"""
-		for data in self.createIterator(filename):
+		if self.pipelineUrl:
+			cache = self.downloadCache if self.canSkipSource(self.source, self.pipelineUrl) else None
+			try:
+				self.fd = threadOpenStream(url=self.pipelineUrl, urlheaders=DOWNLOAD_HEADERS, cache=cache, stats=self.mirrorStats, session=self.session)
+			except RequestException as e:
+				print("[EPGImport][doThreadRead] Failed to open stream:", e, file=log)
+				if filename and deleteFile:
+					unlink_if_exists(filename)
+				return e
+			if self.fd is None:
+				print("[EPGImport][doThreadRead] Source not modified since last import, skipping", self.source.description, file=log)
+				cache.notModified(self.pipelineUrl)
+				if filename and deleteFile:
+					unlink_if_exists(filename)
+				return
+		batch = self.batch
+		fingerprints = self.fingerprints
+		iterator = self.createIterator(filename)
+		samples = self.samples
+		for data in iterator:
+			batch.tick()
 			if data is not None:
 				self.eventCount += 1
 				r, d = data
 				if d[0] > self.longDescUntil:
 					# Remove long description (save RAM memory)
 					d = d[:4] + ("",) + d[5:]
-				try:
-					self.storage.importEvents(r, (d,))
-				except Exception as e:
-					print("[EPGImport][doThreadRead] ### importEvents exception:", e, file=log)
+				samples.add(r, d)
+				if fingerprints is not None and fingerprints.unchanged(r, d):
+					continue
+				batch.add(r, d)
+		batch.flush()
 		print("[EPGImport][doThreadRead] ### thread is ready ### Events:", self.eventCount, file=log)
-		if filename:
+		if self.pipelineUrl and self.fd.error is not None:
+			# the source is incomplete, retry it on another mirror
+			error = self.fd.error
+			self.fd.close()
+			self.fd = None
+			if filename and deleteFile:
+				unlink_if_exists(filename)
+			return error
+		if not self.pipelineUrl:
+			self.sourceImported()
+		elif self.downloadCache is not None and self.fd.eof:
+			# only remember the validators once the whole source went through
+			self.downloadCache.store(self.pipelineUrl, self.fd.response.headers)
+			self.sourceImported()
+		if filename and deleteFile:
 			try:
 				unlink_if_exists(filename)
 			except Exception as e:
 				print("[EPGImport][doThreadRead] warning: Could not remove '%s' intermediate" % filename, e, file=log)
 		return
 
+	def afterThreadRead(self, failure):
+		if failure is not None:
+			# only a pipelined source can fail here, retry it on another mirror
+			self.downloadFail(failure)
+		else:
+			self.nextImport()
+
 	def doRead(self):
 		"""called from reactor to read some data"""
 		try:
 			data = next(self.iterator)
+			self.batch.tick()
 			if data is not None:
 				self.eventCount += 1
 				try:
@@ -449,10 +1256,14 @@ class EPGImport:
 					if d[0] > self.longDescUntil:
 						# Remove long description (save RAM memory)
 						d = d[:4] + ("",) + d[5:]
-					self.storage.importEvents(r, (d,))
+					self.samples.add(r, d)
+					if self.fingerprints is None or not self.fingerprints.unchanged(r, d):
+						self.batch.add(r, d)
 				except Exception as e:
 					print("[EPGImport][doRead] importEvents exception:", e, file=log)
 		except StopIteration:
+			self.batch.flush()
+			self.sourceImported()
 			self.nextImport()
 		return
 
@@ -462,6 +1273,10 @@ class EPGImport:
 		print("[EPGImport][connectionLost]failure", failure, file=log)
 
 	def closeReader(self):
+		self.pipelineUrl = None
+		if self.sourceFile is not None:
+			self.sourceFile.close()
+			self.sourceFile = None
 		if self.fd is not None:
 			reactor.removeReader(self)
 			self.fd.close()
@@ -473,12 +1288,37 @@ class EPGImport:
 		self.closeReader()
 		self.iterator = None
 		self.source = None
+		for result in self.prefetched.values():
+			self.discardPrefetch(result)
+		self.prefetched = {}
+		self.waitingPrefetch = None
 		if hasattr(self.storage, 'epgfile'):
 			needLoad = self.storage.epgfile
 		else:
 			needLoad = None
 
+		if self.batch is not None:
+			self.batch.flush()
+			print("[EPGImport] %d importEvents calls" % self.batch.calls, file=log)
+			self.batch = None
+		changed = True
+		if self.fingerprints is not None:
+			print("[EPGImport] %d changed events imported, %d unchanged events skipped" % (self.fingerprints.changed, self.fingerprints.skipped), file=log)
+			changed = self.fingerprints.changed > 0
+			self.fingerprints.commit()
 		self.storage = None
+		if self.downloadCache is not None:
+			self.downloadCache.save()
+		if self.mirrorStats is not None:
+			self.mirrorStats.save()
+		if self.parserPool is not None:
+			self.parserPool.terminate()
+			self.parserPool = None
+		if self.session is not None:
+			requests, connections = sessionStatistics(self.session)
+			print("[EPGImport] %d HTTP requests over %d connections, %d reused" % (requests, connections, max(requests - connections, 0)), file=log)
+			self.session.close()
+			self.session = None
 
 		if self.eventCount is not None:
 			print("[EPGImport] imported %d events" % self.eventCount, file=log)
@@ -497,7 +1337,7 @@ class EPGImport:
 							unlink_if_exists(needLoad)
 					except Exception as e:
 						print("[EPGImport] load() failed:", e, file=log)
-				elif hasattr(self.epgcache, 'save'):
+				elif hasattr(self.epgcache, 'save') and changed:
 					self.epgcache.save()
 			elif hasattr(self.epgcache, 'timeUpdated'):
 				self.epgcache.timeUpdated()
@@ -0,0 +1,176 @@
+# Download cache for the XMLTV importer
+#
+# Remembers the ETag and Last-Modified headers of every downloaded source
+# and channel file, together with a local copy of the file. The next import
+# sends a conditional request and the server answers "304 Not Modified"
+# when the provider has not regenerated the file.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import threading
+from hashlib import md5
+from os import makedirs, rename, unlink
+from os.path import dirname, exists, getsize, isdir, join, realpath, splitext
+from pickle import dump, load, HIGHEST_PROTOCOL
+from time import time
+
+from . import log
+
+CACHE_INDEX = "/etc/epgimport/downloadcache.pkl"
+CACHE_DIRNAME = "epgimport-cache"
+# Upper limit for the total size of the cached files, in bytes
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+# File systems that keep their files in RAM
+VOLATILE_FILESYSTEMS = ("tmpfs", "ramfs")
+
+
+def onVolatileStorage(path):
+	"""True when path is on a file system in RAM, like /tmp on boxes without
+	a hard disk. A file cached there would take memory for good."""
+	path = realpath(path)
+	mountpoint = ""
+	fstype = None
+	try:
+		with open("/proc/mounts", "r") as f:
+			# format: device mountpoint fstype options
+			for line in f:
+				fields = line.split()
+				if len(fields) > 2 and len(fields[1]) >= len(mountpoint) and (path == fields[1] or path.startswith(fields[1].rstrip("/") + "/")):
+					mountpoint, fstype = fields[1], fields[2]
+	except Exception as e:
+		print("[EPGImport][onVolatileStorage] Failed to read mounts:", e, file=log)
+		return path == "/tmp" or path.startswith("/tmp/")
+	return fstype in VOLATILE_FILESYSTEMS
+
+
+class DownloadCache:
+	"""Persistent, size bounded cache of downloaded files keyed by URL.
+	Every entry is a dict with the keys file, etag, modified, size, used and
+	imported. An entry without file only keeps the validators of a source
+	that was imported without intermediate file. imported is set by the
+	importer once the file went into the EPG completely, see setImported."""
+
+	def __init__(self, filename=CACHE_INDEX, maxSize=DEFAULT_MAX_SIZE):
+		self.filename = filename
+		self.maxSize = maxSize
+		# downloads run in threads
+		self.mutex = threading.Lock()
+		self.entries = {}
+		self.load()
+
+	def load(self):
+		try:
+			with open(self.filename, "rb") as f:
+				self.entries = load(f)
+		except Exception as e:
+			print("[EPGImport][DownloadCache] No cache index", e, file=log)
+			self.entries = {}
+
+	def save(self):
+		with self.mutex:
+			try:
+				with open(self.filename, "wb") as f:
+					dump(self.entries, f, HIGHEST_PROTOCOL)
+			except Exception as e:
+				print("[EPGImport][DownloadCache] Failed to save cache index", e, file=log)
+
+	def lookup(self, url):
+		"""Returns the entry for url, None if there is none or when its file has gone"""
+		with self.mutex:
+			entry = self.entries.get(url)
+			if entry is None:
+				return None
+			if entry["file"] and not exists(entry["file"]):
+				# e.g. cached in /tmp before a reboot
+				del self.entries[url]
+				return None
+			return entry
+
+	def conditionalHeaders(self, url, withoutFile=False):
+		"""Returns the headers for a conditional GET of url. Validators that
+		have no local file are only used when withoutFile is set, i.e. when
+		the caller checked that it can skip url when it did not change."""
+		entry = self.lookup(url)
+		headers = {}
+		if entry is not None and (entry["file"] or withoutFile):
+			if entry["etag"]:
+				headers["If-None-Match"] = entry["etag"]
+			if entry["modified"]:
+				headers["If-Modified-Since"] = entry["modified"]
+		return headers
+
+	def notModified(self, url):
+		"""Marks the entry of url as used and returns its file (may be None)"""
+		entry = self.lookup(url)
+		if entry is None:
+			return None
+		entry["used"] = time()
+		return entry["file"]
+
+	def imported(self, url):
+		"""Returns what was passed to setImported for the current validators
+		of url, None if the file was not imported completely since"""
+		entry = self.lookup(url)
+		return entry.get("imported") if entry is not None else None
+
+	def setImported(self, url, imported):
+		with self.mutex:
+			entry = self.entries.get(url)
+			if entry is not None:
+				entry["imported"] = imported
+
+	def store(self, url, headers, filename=None):
+		"""Remembers the validators in headers for url and moves filename into
+		the cache directory next to it. Returns the new file name, or None if
+		the file was not cached (the caller then still owns filename). A file
+		in RAM is not cached, only its validators are kept. New validators
+		are not imported yet."""
+		etag = headers.get("ETag")
+		modified = headers.get("Last-Modified")
+		self.remove(url)
+		if not etag and not modified:
+			return None
+		cached = None
+		size = 0
+		if filename is not None and onVolatileStorage(dirname(filename)):
+			print("[EPGImport][DownloadCache] Not caching %s, it is in RAM" % filename, file=log)
+			filename = None
+		if filename is not None:
+			size = getsize(filename)
+			if size > self.maxSize:
+				return None
+			cachedir = join(dirname(filename), CACHE_DIRNAME)
+			cached = join(cachedir, md5(url.encode()).hexdigest() + splitext(filename)[1])
+			try:
+				if not isdir(cachedir):
+					makedirs(cachedir)
+				rename(filename, cached)
+			except Exception as e:
+				print("[EPGImport][DownloadCache] Failed to cache %s:" % filename, e, file=log)
+				return None
+		with self.mutex:
+			self.entries[url] = {"file": cached, "etag": etag, "modified": modified, "size": size, "used": time(), "imported": None}
+		self.evict()
+		return cached
+
+	def remove(self, url):
+		with self.mutex:
+			entry = self.entries.pop(url, None)
+		if entry is not None and entry["file"]:
+			try:
+				unlink(entry["file"])
+			except Exception:
+				pass
+
+	def evict(self):
+		"""Drops the least recently used files until the cache fits in maxSize"""
+		with self.mutex:
+			withFile = sorted((entry["used"], url) for url, entry in self.entries.items() if entry["file"])
+			total = sum(self.entries[url]["size"] for used, url in withFile)
+		for used, url in withFile:
+			if total <= self.maxSize:
+				break
+			total -= self.entries[url]["size"]
+			print("[EPGImport][DownloadCache] Evicting", url, file=log)
+			self.remove(url)
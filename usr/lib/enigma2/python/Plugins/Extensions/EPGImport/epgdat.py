@@ -4,14 +4,130 @@
 
 from __future__ import absolute_import, print_function
 
-from datetime import datetime
+from array import array
+from heapq import merge
+from binascii import crc32
 from os import unlink
 from os.path import exists, join
 from struct import Struct, pack
-from time import gmtime
 
 # EpgDatV8 = os.path.isfile("/etc/image-version") and "distro=openvix" in open("/etc/image-version").read()
 EpgDatV8 = True
+# Text kept by each DescriptionCache, in characters
+DESCRIPTION_CACHE_SIZE = 4 * 1024 * 1024
+# Packed descriptions kept in memory before they are written to a run file, in bytes
+DESCRIPTION_STORE_SIZE = 8 * 1024 * 1024
+# crc and reference count in a run file, followed by the packed description
+s_runRecord = Struct("<II")
+
+"""
+this table is used by CRC32 routine below (used by Dreambox for
+computing REF DESC value).
+The original DM routine is a modified CRC32 standard routine,
+so cannot use Python standard binascii.crc32() directly
+"""
+CRCTABLE = (
+	0x00000000, 0x04C11DB7, 0x09823B6E, 0x0D4326D9,
+	0x130476DC, 0x17C56B6B, 0x1A864DB2, 0x1E475005,
+	0x2608EDB8, 0x22C9F00F, 0x2F8AD6D6, 0x2B4BCB61,
+	0x350C9B64, 0x31CD86D3, 0x3C8EA00A, 0x384FBDBD,
+	0x4C11DB70, 0x48D0C6C7, 0x4593E01E, 0x4152FDA9,
+	0x5F15ADAC, 0x5BD4B01B, 0x569796C2, 0x52568B75,
+	0x6A1936C8, 0x6ED82B7F, 0x639B0DA6, 0x675A1011,
+	0x791D4014, 0x7DDC5DA3, 0x709F7B7A, 0x745E66CD,
+	0x9823B6E0, 0x9CE2AB57, 0x91A18D8E, 0x95609039,
+	0x8B27C03C, 0x8FE6DD8B, 0x82A5FB52, 0x8664E6E5,
+	0xBE2B5B58, 0xBAEA46EF, 0xB7A96036, 0xB3687D81,
+	0xAD2F2D84, 0xA9EE3033, 0xA4AD16EA, 0xA06C0B5D,
+	0xD4326D90, 0xD0F37027, 0xDDB056FE, 0xD9714B49,
+	0xC7361B4C, 0xC3F706FB, 0xCEB42022, 0xCA753D95,
+	0xF23A8028, 0xF6FB9D9F, 0xFBB8BB46, 0xFF79A6F1,
+	0xE13EF6F4, 0xE5FFEB43, 0xE8BCCD9A, 0xEC7DD02D,
+	0x34867077, 0x30476DC0, 0x3D044B19, 0x39C556AE,
+	0x278206AB, 0x23431B1C, 0x2E003DC5, 0x2AC12072,
+	0x128E9DCF, 0x164F8078, 0x1B0CA6A1, 0x1FCDBB16,
+	0x018AEB13, 0x054BF6A4, 0x0808D07D, 0x0CC9CDCA,
+	0x7897AB07, 0x7C56B6B0, 0x71159069, 0x75D48DDE,
+	0x6B93DDDB, 0x6F52C06C, 0x6211E6B5, 0x66D0FB02,
+	0x5E9F46BF, 0x5A5E5B08, 0x571D7DD1, 0x53DC6066,
+	0x4D9B3063, 0x495A2DD4, 0x44190B0D, 0x40D816BA,
+	0xACA5C697, 0xA864DB20, 0xA527FDF9, 0xA1E6E04E,
+	0xBFA1B04B, 0xBB60ADFC, 0xB6238B25, 0xB2E29692,
+	0x8AAD2B2F, 0x8E6C3698, 0x832F1041, 0x87EE0DF6,
+	0x99A95DF3, 0x9D684044, 0x902B669D, 0x94EA7B2A,
+	0xE0B41DE7, 0xE4750050, 0xE9362689, 0xEDF73B3E,
+	0xF3B06B3B, 0xF771768C, 0xFA325055, 0xFEF34DE2,
+	0xC6BCF05F, 0xC27DEDE8, 0xCF3ECB31, 0xCBFFD686,
+	0xD5B88683, 0xD1799B34, 0xDC3ABDED, 0xD8FBA05A,
+	0x690CE0EE, 0x6DCDFD59, 0x608EDB80, 0x644FC637,
+	0x7A089632, 0x7EC98B85, 0x738AAD5C, 0x774BB0EB,
+	0x4F040D56, 0x4BC510E1, 0x46863638, 0x42472B8F,
+	0x5C007B8A, 0x58C1663D, 0x558240E4, 0x51435D53,
+	0x251D3B9E, 0x21DC2629, 0x2C9F00F0, 0x285E1D47,
+	0x36194D42, 0x32D850F5, 0x3F9B762C, 0x3B5A6B9B,
+	0x0315D626, 0x07D4CB91, 0x0A97ED48, 0x0E56F0FF,
+	0x1011A0FA, 0x14D0BD4D, 0x19939B94, 0x1D528623,
+	0xF12F560E, 0xF5EE4BB9, 0xF8AD6D60, 0xFC6C70D7,
+	0xE22B20D2, 0xE6EA3D65, 0xEBA91BBC, 0xEF68060B,
+	0xD727BBB6, 0xD3E6A601, 0xDEA580D8, 0xDA649D6F,
+	0xC423CD6A, 0xC0E2D0DD, 0xCDA1F604, 0xC960EBB3,
+	0xBD3E8D7E, 0xB9FF90C9, 0xB4BCB610, 0xB07DABA7,
+	0xAE3AFBA2, 0xAAFBE615, 0xA7B8C0CC, 0xA379DD7B,
+	0x9B3660C6, 0x9FF77D71, 0x92B45BA8, 0x9675461F,
+	0x8832161A, 0x8CF30BAD, 0x81B02D74, 0x857130C3,
+	0x5D8A9099, 0x594B8D2E, 0x5408ABF7, 0x50C9B640,
+	0x4E8EE645, 0x4A4FFBF2, 0x470CDD2B, 0x43CDC09C,
+	0x7B827D21, 0x7F436096, 0x7200464F, 0x76C15BF8,
+	0x68860BFD, 0x6C47164A, 0x61043093, 0x65C52D24,
+	0x119B4BE9, 0x155A565E, 0x18197087, 0x1CD86D30,
+	0x029F3D35, 0x065E2082, 0x0B1D065B, 0x0FDC1BEC,
+	0x3793A651, 0x3352BBE6, 0x3E119D3F, 0x3AD08088,
+	0x2497D08D, 0x2056CD3A, 0x2D15EBE3, 0x29D4F654,
+	0xC5A92679, 0xC1683BCE, 0xCC2B1D17, 0xC8EA00A0,
+	0xD6AD50A5, 0xD26C4D12, 0xDF2F6BCB, 0xDBEE767C,
+	0xE3A1CBC1, 0xE760D676, 0xEA23F0AF, 0xEEE2ED18,
+	0xF0A5BD1D, 0xF464A0AA, 0xF9278673, 0xFDE69BC4,
+	0x89B8FD09, 0x8D79E0BE, 0x803AC667, 0x84FBDBD0,
+	0x9ABC8BD5, 0x9E7D9662, 0x933EB0BB, 0x97FFAD0C,
+	0xAFB010B1, 0xAB710D06, 0xA6322BDF, 0xA2F33668,
+	0xBCB4666D, 0xB8757BDA, 0xB5365D03, 0xB1F740B4
+)
+
+
+def crc32_dreambox_table(crcdata, crctype, crctable=CRCTABLE):
+	"""
+	CRC32 in Dreambox/DVB way (see CRCTABLE comment above)
+	"crcdata" is the description string
+	"crctype" is the description type (1 byte 0x4d or 0x4e)
+	!!!!!!!!! IT'S VERY TIME CONSUMING !!!!!!!!!
+	Reference implementation, one table lookup per byte
+	"""
+	crc = crctable[crctype & 0x000000ff]
+	crc = ((crc << 8) & 0xffffff00) ^ crctable[((crc >> 24) ^ len(crcdata)) & 0x000000ff]
+	for d in bytearray(crcdata):
+		crc = ((crc << 8) & 0xffffff00) ^ crctable[((crc >> 24) ^ d) & 0x000000ff]
+	return crc
+
+
+# every byte value with its bit order reversed
+REVERSED_BITS = bytes(bytearray(int("{0:08b}".format(i)[::-1], 2) for i in range(256)))
+s_BB = Struct("BB")
+s_bigI = Struct(">I")
+s_littleI = Struct("<I")
+
+
+def crc32_dreambox_binascii(crcdata, crctype):
+	"""
+	Same result as crc32_dreambox_table, computed by binascii.crc32 in C.
+	The Dreambox CRC is the not reflected CRC32 with 0 as initial value and
+	no final xor, binascii.crc32 the reflected one: reversing the bits of
+	every input byte and of the result turns one into the other, and 0xFFFFFFFF
+	as previous value cancels the inversion at the start and the end.
+	"""
+	crcdata = (s_BB.pack(crctype & 0xff, len(crcdata) & 0xff) + crcdata).translate(REVERSED_BITS)
+	crc = (crc32(crcdata, 0xFFFFFFFF) & 0xFFFFFFFF) ^ 0xFFFFFFFF
+	return s_littleI.unpack(s_bigI.pack(crc).translate(REVERSED_BITS))[0]
+
 
 try:
 	from . import dreamcrc
@@ -22,107 +138,131 @@ try:
 	# crc32_dreambox = lambda d, t: dreamcrc.crc32(d, t) & 0xffffffff
 	print("[EPGImport] using C module, yay")
 except ImportError:
-	print("[EPGImport] failed to load C implementation, sorry")
-	"""
-	this table is used by CRC32 routine below (used by Dreambox for
-	computing REF DESC value).
-	The original DM routine is a modified CRC32 standard routine,
-	so cannot use Python standard binascii.crc32()
-	"""
-	CRCTABLE = (
-		0x00000000, 0x04C11DB7, 0x09823B6E, 0x0D4326D9,
-		0x130476DC, 0x17C56B6B, 0x1A864DB2, 0x1E475005,
-		0x2608EDB8, 0x22C9F00F, 0x2F8AD6D6, 0x2B4BCB61,
-		0x350C9B64, 0x31CD86D3, 0x3C8EA00A, 0x384FBDBD,
-		0x4C11DB70, 0x48D0C6C7, 0x4593E01E, 0x4152FDA9,
-		0x5F15ADAC, 0x5BD4B01B, 0x569796C2, 0x52568B75,
-		0x6A1936C8, 0x6ED82B7F, 0x639B0DA6, 0x675A1011,
-		0x791D4014, 0x7DDC5DA3, 0x709F7B7A, 0x745E66CD,
-		0x9823B6E0, 0x9CE2AB57, 0x91A18D8E, 0x95609039,
-		0x8B27C03C, 0x8FE6DD8B, 0x82A5FB52, 0x8664E6E5,
-		0xBE2B5B58, 0xBAEA46EF, 0xB7A96036, 0xB3687D81,
-		0xAD2F2D84, 0xA9EE3033, 0xA4AD16EA, 0xA06C0B5D,
-		0xD4326D90, 0xD0F37027, 0xDDB056FE, 0xD9714B49,
-		0xC7361B4C, 0xC3F706FB, 0xCEB42022, 0xCA753D95,
-		0xF23A8028, 0xF6FB9D9F, 0xFBB8BB46, 0xFF79A6F1,
-		0xE13EF6F4, 0xE5FFEB43, 0xE8BCCD9A, 0xEC7DD02D,
-		0x34867077, 0x30476DC0, 0x3D044B19, 0x39C556AE,
-		0x278206AB, 0x23431B1C, 0x2E003DC5, 0x2AC12072,
-		0x128E9DCF, 0x164F8078, 0x1B0CA6A1, 0x1FCDBB16,
-		0x018AEB13, 0x054BF6A4, 0x0808D07D, 0x0CC9CDCA,
-		0x7897AB07, 0x7C56B6B0, 0x71159069, 0x75D48DDE,
-		0x6B93DDDB, 0x6F52C06C, 0x6211E6B5, 0x66D0FB02,
-		0x5E9F46BF, 0x5A5E5B08, 0x571D7DD1, 0x53DC6066,
-		0x4D9B3063, 0x495A2DD4, 0x44190B0D, 0x40D816BA,
-		0xACA5C697, 0xA864DB20, 0xA527FDF9, 0xA1E6E04E,
-		0xBFA1B04B, 0xBB60ADFC, 0xB6238B25, 0xB2E29692,
-		0x8AAD2B2F, 0x8E6C3698, 0x832F1041, 0x87EE0DF6,
-		0x99A95DF3, 0x9D684044, 0x902B669D, 0x94EA7B2A,
-		0xE0B41DE7, 0xE4750050, 0xE9362689, 0xEDF73B3E,
-		0xF3B06B3B, 0xF771768C, 0xFA325055, 0xFEF34DE2,
-		0xC6BCF05F, 0xC27DEDE8, 0xCF3ECB31, 0xCBFFD686,
-		0xD5B88683, 0xD1799B34, 0xDC3ABDED, 0xD8FBA05A,
-		0x690CE0EE, 0x6DCDFD59, 0x608EDB80, 0x644FC637,
-		0x7A089632, 0x7EC98B85, 0x738AAD5C, 0x774BB0EB,
-		0x4F040D56, 0x4BC510E1, 0x46863638, 0x42472B8F,
-		0x5C007B8A, 0x58C1663D, 0x558240E4, 0x51435D53,
-		0x251D3B9E, 0x21DC2629, 0x2C9F00F0, 0x285E1D47,
-		0x36194D42, 0x32D850F5, 0x3F9B762C, 0x3B5A6B9B,
-		0x0315D626, 0x07D4CB91, 0x0A97ED48, 0x0E56F0FF,
-		0x1011A0FA, 0x14D0BD4D, 0x19939B94, 0x1D528623,
-		0xF12F560E, 0xF5EE4BB9, 0xF8AD6D60, 0xFC6C70D7,
-		0xE22B20D2, 0xE6EA3D65, 0xEBA91BBC, 0xEF68060B,
-		0xD727BBB6, 0xD3E6A601, 0xDEA580D8, 0xDA649D6F,
-		0xC423CD6A, 0xC0E2D0DD, 0xCDA1F604, 0xC960EBB3,
-		0xBD3E8D7E, 0xB9FF90C9, 0xB4BCB610, 0xB07DABA7,
-		0xAE3AFBA2, 0xAAFBE615, 0xA7B8C0CC, 0xA379DD7B,
-		0x9B3660C6, 0x9FF77D71, 0x92B45BA8, 0x9675461F,
-		0x8832161A, 0x8CF30BAD, 0x81B02D74, 0x857130C3,
-		0x5D8A9099, 0x594B8D2E, 0x5408ABF7, 0x50C9B640,
-		0x4E8EE645, 0x4A4FFBF2, 0x470CDD2B, 0x43CDC09C,
-		0x7B827D21, 0x7F436096, 0x7200464F, 0x76C15BF8,
-		0x68860BFD, 0x6C47164A, 0x61043093, 0x65C52D24,
-		0x119B4BE9, 0x155A565E, 0x18197087, 0x1CD86D30,
-		0x029F3D35, 0x065E2082, 0x0B1D065B, 0x0FDC1BEC,
-		0x3793A651, 0x3352BBE6, 0x3E119D3F, 0x3AD08088,
-		0x2497D08D, 0x2056CD3A, 0x2D15EBE3, 0x29D4F654,
-		0xC5A92679, 0xC1683BCE, 0xCC2B1D17, 0xC8EA00A0,
-		0xD6AD50A5, 0xD26C4D12, 0xDF2F6BCB, 0xDBEE767C,
-		0xE3A1CBC1, 0xE760D676, 0xEA23F0AF, 0xEEE2ED18,
-		0xF0A5BD1D, 0xF464A0AA, 0xF9278673, 0xFDE69BC4,
-		0x89B8FD09, 0x8D79E0BE, 0x803AC667, 0x84FBDBD0,
-		0x9ABC8BD5, 0x9E7D9662, 0x933EB0BB, 0x97FFAD0C,
-		0xAFB010B1, 0xAB710D06, 0xA6322BDF, 0xA2F33668,
-		0xBCB4666D, 0xB8757BDA, 0xB5365D03, 0xB1F740B4
-	)
-	"""
-	CRC32 in Dreambox/DVB way (see CRCTABLE comment above)
-	"crcdata" is the description string
-	"crctype" is the description type (1 byte 0x4d or 0x4e)
-	!!!!!!!!! IT'S VERY TIME CONSUMING !!!!!!!!!
-	"""
+	print("[EPGImport] failed to load C implementation, using binascii")
+	crc32_dreambox = crc32_dreambox_binascii
 
-	def crc32_dreambox(crcdata, crctype, crctable=CRCTABLE):
-		"""
-		ML Optimized: local CRCTABLE (locals are faster), remove self, remove code that has no effect, faster loop
-		crc=0x00000000
-		crc=((crc << 8 ) & 0xffffff00) ^ crctable[((crc >> 24) ^ crctype) & 0x000000ff]
-		"""
-		crc = crctable[crctype & 0x000000ff]
-		crc = ((crc << 8) & 0xffffff00) ^ crctable[((crc >> 24) ^ len(crcdata)) & 0x000000ff]
-		for d in crcdata:
-			crc = ((crc << 8) & 0xffffff00) ^ crctable[((crc >> 24) ^ ord(d)) & 0x000000ff]
-		return crc
 
-
-# convert time or length from datetime format to 3 bytes hex value
+# BCD byte of the numbers 0 to 99 to convert times and lengths
 # i.e. 20:25:30 -> 0x20 , 0x25 , 0x30
-def TL_hexconv(dt):
-	return (
-		(dt.hour % 10) + (16 * (dt.hour // 10)),
-		(dt.minute % 10) + (16 * (dt.minute // 10)),
-		(dt.second % 10) + (16 * (dt.second // 10))
-	)
+BCD = tuple((i // 10) * 16 + i % 10 for i in range(100))
+
+
+class DescriptionStore:
+	"""The descriptions of an epg.dat keyed by their CRC, with the number of
+	events that refer to them. The packed descriptions (type, length, data)
+	are appended to one bytearray, the index maps a CRC to its slot in the
+	offset and reference count arrays. Once the packed descriptions reach
+	budget bytes they are written to a run file sorted by CRC and the store
+	starts over, so memory use stays bounded on a full week import."""
+
+	def __init__(self, runPrefix, budget=DESCRIPTION_STORE_SIZE):
+		self.runPrefix = runPrefix
+		self.budget = budget
+		self.runs = []
+		self.header = Struct("BB")
+		self.reset()
+
+	def reset(self):
+		self.index = {}
+		self.arena = bytearray()
+		self.offsets = array("I")
+		self.counts = array("I")
+
+	def add(self, crc, descType, data, references=1):
+		"""Adds references to description crc, its data is only packed and
+		stored on the first one"""
+		slot = self.index.get(crc)
+		if slot is not None:
+			self.counts[slot] += references
+			return
+		self.index[crc] = len(self.counts)
+		self.offsets.append(len(self.arena))
+		self.counts.append(references)
+		self.arena += self.header.pack(descType, len(data))
+		self.arena += data
+		if len(self.arena) >= self.budget:
+			self.spill()
+
+	def memoryItems(self):
+		"""Yields (crc, reference count, packed description) of the descriptions
+		in memory in CRC order"""
+		arena = self.arena
+		offsets = self.offsets
+		counts = self.counts
+		for crc in sorted(self.index):
+			slot = self.index[crc]
+			offset = offsets[slot]
+			yield crc, counts[slot], bytes(arena[offset:offset + 2 + arena[offset + 1]])
+
+	def spill(self):
+		filename = "%s.%d" % (self.runPrefix, len(self.runs))
+		s_run = s_runRecord
+		with open(filename, "wb") as f:
+			for crc, count, packed in self.memoryItems():
+				f.write(s_run.pack(crc, count) + packed)
+		self.runs.append(filename)
+		print("[EPGImport][DescriptionStore] Wrote %d descriptions to %s" % (len(self.counts), filename))
+		self.reset()
+
+	def sortedItems(self):
+		"""Yields (crc, reference count, packed description) in CRC order,
+		merging the runs and the descriptions in memory. A CRC that is in
+		several of them is yielded once with the summed reference count."""
+		previous = total = data = None
+		for crc, count, packed in merge(self.memoryItems(), *[readRun(filename) for filename in self.runs]):
+			if crc == previous:
+				total += count
+				continue
+			if previous is not None:
+				yield previous, total, data
+			previous, total, data = crc, count, packed
+		if previous is not None:
+			yield previous, total, data
+
+	def removeRuns(self):
+		for filename in self.runs:
+			if exists(filename):
+				unlink(filename)
+		self.runs = []
+
+	def close(self):
+		"""Removes the run files and drops the descriptions in memory"""
+		self.removeRuns()
+		self.reset()
+
+
+def readRun(filename):
+	"""Yields (crc, reference count, packed description) of a run file"""
+	s_run = s_runRecord
+	with open(filename, "rb") as f:
+		while True:
+			header = f.read(s_run.size + 2)
+			if not header:
+				break
+			crc, count = s_run.unpack(header[:s_run.size])
+			yield crc, count, header[s_run.size:] + f.read(ord(header[-1:]))
+
+
+class DescriptionCache:
+	"""Maps a text to the result of build(text), the packed descriptions with
+	their CRCs, so a repeated title or description is only packed and hashed
+	once per epg.dat. The cache is emptied when it holds maxSize characters."""
+
+	def __init__(self, build, maxSize=DESCRIPTION_CACHE_SIZE):
+		self.build = build
+		self.maxSize = maxSize
+		self.entries = {}
+		self.size = 0
+
+	def get(self, text):
+		result = self.entries.get(text)
+		if result is None:
+			if self.size >= self.maxSize:
+				self.entries.clear()
+				self.size = 0
+			result = self.entries[text] = self.build(text)
+			self.size += len(text)
+		return result
 
 
 class epgdat_class:
@@ -135,19 +275,10 @@ class epgdat_class:
 	LB_ENDIAN = '<'
 
 	EPG_HEADER1_channel_count = 0
-	EPG_HEADER2_description_count = 0
 	EPG_TOTAL_EVENTS = 0
 
 	EXCLUDED_SID = []
 
-	# initialize an empty dictionary (Python array)
-	# as total events container postprocessed
-	EPGDAT_HASH_EVENT_MEMORY_CONTAINER = {}
-
-	# initialize an empty dictionary (Python array)
-	# as channel events container before preprocessing
-	events = []
-
 	# initialize an empty dictionary (Python array)
 	# the following format can handle duplicated channel name
 	# format: { channel_name : [ sid , sid , .... ] }
@@ -158,16 +289,26 @@ class epgdat_class:
 	# Using 'proleptic' we can compute correct days as difference from NOW and 17/11/1858
 	#  datetime.datetime.toordinal(1858,11,17) => 678576
 	EPG_PROLEPTIC_ZERO_DAY = 678576
+	# epg.dat day of 1 January 1970, where unix time starts: proleptic 719163 - 678576
+	EPG_EPOCH_DAY = 40587
 
 	def __init__(self, tmp_path, lamedb_path, epgdat_path):
 		self.EPGDAT_FILENAME = epgdat_path
 		self.EPGDAT_TMP_FILENAME = join(tmp_path, self.EPGDAT_TMP_FILENAME)
 		self.EPG_TMP_FD = open(self.EPGDAT_TMP_FILENAME, "wb")
 		self.LAMEDB = lamedb_path
+		# all descriptions of the epg.dat, postprocessed
+		self.descriptions = DescriptionStore(self.EPGDAT_TMP_FILENAME)
+		# channel events container before preprocessing
+		self.events = []
+		self.titles = DescriptionCache(self.shortDescription)
+		self.longDescriptions = DescriptionCache(self.longDescription)
 		self.s_B = Struct("B")
 		self.s_BB = Struct("BB")
 		self.s_BBB = Struct("BBB")
 		self.s_b_HH = Struct(">HH")
+		# EVENT HEADER, ID and DATE, start time and duration
+		self.s_b_BBBHHBBBBBB = Struct(">BBBHHBBBBBB")
 		self.s_I = Struct(self.LB_ENDIAN + "I")
 		self.s_II = Struct(self.LB_ENDIAN + "II")
 		self.s_IIII = Struct(self.LB_ENDIAN + "IIII")
@@ -209,83 +350,66 @@ class epgdat_class:
 
 	def add_event(self, starttime, duration, title, description):
 		# print("[epgdat][add_event]add event:- starttime, duration, title, description", starttime, duration, title, description)
-		self.events.append((starttime, duration, self.shortDescription(title[:240]), self.longDescription(description)))
+		self.events.append((starttime, duration, self.titles.get(title[:240]), self.longDescriptions.get(description)))
 
 	def preprocess_events_channel(self, services):
-		EPG_EVENT_DATA_id = 0
-		for service in services:
-			# print("[epgdat][preprocess_events_channel] service : ", service)
-			# skip empty lines, they make a mess
-			if not service.strip():
-				continue
-			# prepare and write CHANNEL INFO record
-			ssid = service.split(":")
-			# write CHANNEL INFO record (sid, onid, tsid, eventcount)
-			self.EPG_TMP_FD.write(self.s_IIII.pack(int(ssid[3], 16), int(ssid[5], 16), int(ssid[4], 16), int(len(self.events))))
-			self.EPG_HEADER1_channel_count += 1
-			# event_dict.keys() are numeric so indexing is possibile
-			# key is the same thing as counter and is more simple to manage last-1 item
-			events = self.events
-			s_BB = self.s_BB
-			s_BBB = self.s_BBB
-			s_I = self.s_I
-			for event in events:
+		# skip empty lines, they make a mess
+		services = [service for service in services if service.strip()]
+		s_I = self.s_I
+		# the events are the same for every service, so everything but the
+		# event id is computed once and the descriptions get a reference per service
+		packed = []
+		if services:
+			descriptions = self.descriptions
+			references = len(services)
+			for event in self.events:
 				# **** (1) : create DESCRIPTION HEADER / DATA ****
 
-				EPG_EVENT_HEADER_datasize = 0
-
 				# short description (title) type 0x4d   self.shortDescription(title[:240]) = event[2]
 				shortDescription = event[2]  # (crc32, short description packed)
-				EPG_EVENT_HEADER_datasize += 4  # add 4 bytes for a single REF DESC (CRC32)
-
-				if shortDescription[0] not in list(self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER.keys()):
-					pack_1 = s_BB.pack(0x4d, int(len(shortDescription[1]))) + shortDescription[1]  # DESCRIPTION DATA
-					# DESCRIPTION HEADER (2 int) will be computed at the end just before EPG.DAT write
-					# because it needs the total number of the same descriptions called by any channel section
-					self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER[shortDescription[0]] = [pack_1, 1]  # save CRC32 and short description data packed
-					self.EPG_HEADER2_description_count += 1
-				else:
-					# increment_event(shortDescription[0])
-					self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER[shortDescription[0]][1] += 1
+				# DESCRIPTION HEADER (2 int) will be computed at the end just before EPG.DAT write
+				# because it needs the total number of the same descriptions called by any channel section
+				descriptions.add(shortDescription[0], 0x4d, shortDescription[1], references)
 
 				# long description type 0x4e  self.longDescription(description) = event[3]
 				longDescription = event[3]  # (crc32, long description(s) packed)
-				EPG_EVENT_HEADER_datasize += 4 * len(longDescription)  # add 4 bytes for each CRC32
 				for desc in longDescription:  # desc = crc + packed long desc
-					if desc[0] not in list(self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER.keys()):
-						# DESCRIPTION DATA
-						pack_2 = s_BB.pack(0x4e, int(len(desc[1]))) + desc[1]  # short description
-						self.EPG_HEADER2_description_count += 1
-						# DESCRIPTION HEADER (2 int) will be computed at the end just before EPG.DAT write
-						# because it need the total number of the same description called by different channel section
-						# save_event(longDescription[i][0],[pack_1,1])
-						self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER[desc[0]] = [pack_2, 1]  # save crc32 and description packed
-					else:
-						# increment_event(longDescription[i][0])
-						self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER[desc[0]][1] += 1
+					descriptions.add(desc[0], 0x4e, desc[1], references)
 
 				# **** (2) : have all crc32's and now can create EVENT HEADER / DATA ****
 				# EVENT HEADER (3 bytes: 0x01 , 0x00, 10 bytes + number of CRC32 * 4)
-				pack_3 = s_BBB.pack(0x01, 0x00, 0x0a + EPG_EVENT_HEADER_datasize)
-				self.EPG_TMP_FD.write(pack_3)
-
-				# extract date and time from <event> event numbers are seconds
-				# unix format (second since 1970) and already GMT corrected
-				event_time_HMS = datetime.utcfromtimestamp(event[0])  # actually YYYY-MM-DD HH:MM:SS
-				dvb_date = event_time_HMS.toordinal() - self.EPG_PROLEPTIC_ZERO_DAY  # epg.dat date is = (proleptic date - epg_zero_day)
-				# event_duration_HMS = datetime.utcfromtimestamp(event[1])  # actually 1970-01-01 HH:MM:SS
-				event_duration_HMS = datetime.datetime(*gmtime(event[1])[:6])  # actually 1970-01-01 HH:MM:SS
+				# 4 bytes for a single REF DESC (CRC32) of the title and for each long description
+				size = 0x0a + 4 + 4 * len(longDescription)
+
+				# event numbers are seconds unix format (second since 1970) and already GMT corrected
+				days, seconds = divmod(int(event[0]), 86400)
+				minutes, second = divmod(seconds, 60)
+				hour, minute = divmod(minutes, 60)
+				dvb_date = days + self.EPG_EPOCH_DAY  # epg.dat date is = (proleptic date - epg_zero_day)
+				# duration as time of day, actually 1970-01-01 HH:MM:SS
+				minutes, duration_second = divmod(int(event[1]) % 86400, 60)
+				duration_hour, duration_minute = divmod(minutes, 60)
+				crcs = s_I.pack(shortDescription[0])  # REF DESC crc short (title)
+				for description in longDescription:
+					crcs += s_I.pack(description[0])  # REF DESC long
+				packed.append((size, dvb_date, BCD[hour], BCD[minute], BCD[second], BCD[duration_hour], BCD[duration_minute], BCD[duration_second], crcs))
+		EPG_EVENT_DATA_id = 0
+		pack_event = self.s_b_BBBHHBBBBBB.pack
+		write = self.EPG_TMP_FD.write
+		for service in services:
+			# print("[epgdat][preprocess_events_channel] service : ", service)
+			# prepare and write CHANNEL INFO record
+			ssid = service.split(":")
+			# write CHANNEL INFO record (sid, onid, tsid, eventcount)
+			write(self.s_IIII.pack(int(ssid[3], 16), int(ssid[5], 16), int(ssid[4], 16), int(len(self.events))))
+			self.EPG_HEADER1_channel_count += 1
+			for size, dvb_date, hour, minute, second, duration_hour, duration_minute, duration_second, crcs in packed:
 				# EVENT DATA
 				# simply create an incremental ID,  starting from '1'
 				# event_id appears to be per channel, so this should be okay.
 				EPG_EVENT_DATA_id += 1
-				pack_4 = self.s_b_HH.pack(EPG_EVENT_DATA_id, dvb_date)  # ID and DATE , always in BIG_ENDIAN
-				pack_5 = s_BBB.pack(*TL_hexconv(event_time_HMS))  # Start time
-				pack_6 = s_BBB.pack(*TL_hexconv(event_duration_HMS))  # Duration
-				pack_7 = s_I.pack(shortDescription[0])  # REF DESC crc short (title)
-				for description in longDescription:
-					pack_7 += s_I.pack(description[0])  # REF DESC long
-				self.EPG_TMP_FD.write(pack_4 + pack_5 + pack_6 + pack_7)
+				# EVENT HEADER, ID and DATE (always in BIG_ENDIAN), BCD start time and duration
+				write(pack_event(0x01, 0x00, size, EPG_EVENT_DATA_id, dvb_date, hour, minute, second, duration_hour, duration_minute, duration_second) + crcs)
 		# reset again event container
 		self.EPG_TOTAL_EVENTS += len(self.events)
 		self.events = []
@@ -309,16 +433,26 @@ class epgdat_class:
 				epgdat_fd.write(pack_1)
 			EPG_TMP_FD.close()
 			# HEADER 2
+			# the number of descriptions is only known after merging the runs,
+			# write a placeholder and fill it in at the end
 			s_ii = self.s_II
-			pack_2 = self.s_I.pack(self.EPG_HEADER2_description_count)
-			epgdat_fd.write(pack_2)
+			header2 = epgdat_fd.tell()
+			epgdat_fd.write(self.s_I.pack(0))
+			description_count = 0
 			# event MUST BE WRITTEN IN ASCENDING ORDERED using HASH CODE as index
-			for temp in sorted(list(self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER.keys())):
-				temp_crc_data = self.EPGDAT_HASH_EVENT_MEMORY_CONTAINER[temp]
-				# pack_4=struct.pack(LB_ENDIAN+"II",int(temp,16),temp_crc_data[1])
-				pack_4 = s_ii.pack(temp, temp_crc_data[1])  # crc and packed data
-				epgdat_fd.write(pack_4 + temp_crc_data[0])  # packed (crc, packed data) & crc
+			for crc, count, packed in self.descriptions.sortedItems():
+				pack_4 = s_ii.pack(crc, count)  # crc and reference count
+				epgdat_fd.write(pack_4 + packed)  # packed (crc, count) & packed data
+				description_count += 1
+			epgdat_fd.seek(header2)
+			epgdat_fd.write(self.s_I.pack(description_count))
 			epgdat_fd.close()
-		# *** cleanup **
+		self.cleanup()
+
+	def cleanup(self):
+		"""Removes the temporary files, also when the epg.dat was not completed"""
+		if not self.EPG_TMP_FD.closed:
+			self.EPG_TMP_FD.close()
 		if exists(self.EPGDAT_TMP_FILENAME):
 			unlink(self.EPGDAT_TMP_FILENAME)
+		self.descriptions.close()
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# Checks the binascii based CRC of epgdat.py against the table based one and
+# the values of the dreamcrc C module, and compares their speed. Run it from
+# this directory:
+#
+#	python epgdat_check.py
+
+from __future__ import print_function
+
+from random import Random
+from timeit import timeit
+
+from epgdat import crc32_dreambox_binascii, crc32_dreambox_table
+
+# descriptions and their CRCs as computed by the dreamcrc C module
+KNOWN_CRCS = (
+	(b"eng\x05\x15News\x00", 0x4d, 0x81221BB4),
+	(b"eng\t\x15Journaal\x00", 0x4d, 0x9511F18B),
+	(b"\x00eng\x00\x1a\x15Dagelijks nieuws en weer.", 0x4e, 0x43610404),
+	(b"", 0x4d, 0x5C33CF6B),
+)
+
+
+def main():
+	for crcdata, crctype, crc in KNOWN_CRCS:
+		assert crc32_dreambox_table(crcdata, crctype) == crc, crcdata
+		assert crc32_dreambox_binascii(crcdata, crctype) == crc, crcdata
+	random = Random(1)
+	samples = [(bytes(bytearray(random.randrange(256) for i in range(random.randrange(300)))), random.choice((0x4d, 0x4e))) for i in range(2000)]
+	for crcdata, crctype in samples:
+		assert crc32_dreambox_binascii(crcdata, crctype) == crc32_dreambox_table(crcdata, crctype), crcdata
+	print("%d CRCs computed identically" % (len(KNOWN_CRCS) + len(samples)))
+	number = 5
+	old = timeit(lambda: [crc32_dreambox_table(*sample) for sample in samples], number=number)
+	new = timeit(lambda: [crc32_dreambox_binascii(*sample) for sample in samples], number=number)
+	count = len(samples) * number
+	print("table: %.2f us, binascii: %.2f us per description" % (old * 1e6 / count, new * 1e6 / count))
+
+
+if __name__ == "__main__":
+	main()
@@ -51,6 +51,7 @@ class epgdatclass:
 			print("[EPGImport] Failure in epg_done")
 			import traceback
 			traceback.print_exc()
+			self.epg.cleanup()
 		self.epg = None
 
 	def checkPath(self, path):
@@ -0,0 +1,233 @@
+# Parsed event cache for the XMLTV importer
+#
+# Keeps the events of a parsed source file in a compact binary form, keyed
+# by the file contents and the channel mapping. Importing the same file
+# again replays the events at disk speed instead of parsing the XML.
+#
+# A cache file is a stream of pickled blocks, written while the source is
+# parsed and read back one at a time, so neither side holds a whole source
+# in memory.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+from array import array
+from hashlib import md5
+from os import listdir, makedirs, remove, rename, utime
+from os.path import exists, getmtime, isdir, join
+from pickle import dump, load, HIGHEST_PROTOCOL
+
+from . import log
+
+CACHE_DIRNAME = "epgimport-events"
+# Number of cached source files kept
+CACHE_FILES = 5
+CACHE_VERSION = 2
+# Stored instead of a missing parental rating
+NO_RATING = -0x7fffffff
+# Events written per block
+BLOCK_EVENTS = 1000
+# Characters of titles and descriptions in the string table before it is
+# started over, this bounds the memory used to record and to replay
+STRING_TABLE_SIZE = 1024 * 1024
+
+
+def cacheKey(fileobj, channels, *options):
+	"""Key of the events of the raw source file 'fileobj' converted with the
+	channel mapping 'channels' and the parser options"""
+	key = md5(repr((CACHE_VERSION, sorted(channels.items()), options)).encode())
+	fileobj.seek(0)
+	while True:
+		data = fileobj.read(65536)
+		if not data:
+			break
+		key.update(data)
+	return key.hexdigest()
+
+
+class EventRecorder:
+	"""Writes the events of one source to 'filename' in blocks of consecutive
+	events of the same services. A block holds arrays of start, duration,
+	category and rating, and indexes into a string table that holds every
+	distinct title and description once. The block carries the strings it
+	added to the table, and whether the table was started over first."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, "wb")
+		dump(CACHE_VERSION, self.file, HIGHEST_PROTOCOL)
+		self.stringIndex = {}
+		self.stringSize = 0
+		self.reset = False
+		self.newStrings = []
+		self.services = None
+		self.columns = None
+		self.failed = False
+
+	def text(self, s):
+		index = self.stringIndex.get(s)
+		if index is None:
+			index = self.stringIndex[s] = len(self.stringIndex)
+			self.newStrings.append(s)
+			self.stringSize += len(s)
+		return index
+
+	def newBlock(self, services):
+		self.services = services
+		self.columns = (array("l"), array("l"), array("l"), array("l"), array("L"), array("L"), array("L"))
+
+	def writeBlock(self):
+		if self.services is not None and len(self.columns[0]):
+			dump((self.reset, self.newStrings, list(self.services)) + self.columns, self.file, HIGHEST_PROTOCOL)
+			self.reset = False
+			self.newStrings = []
+			if self.stringSize >= STRING_TABLE_SIZE:
+				self.stringIndex = {}
+				self.stringSize = 0
+				self.reset = True
+		self.services = None
+
+	def add(self, services, event):
+		if self.failed:
+			return
+		try:
+			if services is not self.services:
+				self.writeBlock()
+				self.newBlock(services)
+			if len(event) == 6:
+				rating = NO_RATING
+			elif len(event) == 8 and event[6] == 0 and len(event[7]) == 1 and event[7][0][0] == "eng":
+				rating = event[7][0][1]
+			else:
+				raise ValueError("unexpected event %r" % (event,))
+			columns = self.columns
+			for values, value in zip(columns, (event[0], event[1], event[5], rating)):
+				values.append(value)
+			columns[4].append(self.text(event[2]))
+			columns[5].append(self.text(event[3]))
+			columns[6].append(self.text(event[4]))
+			if len(columns[0]) >= BLOCK_EVENTS:
+				self.writeBlock()
+		except (ValueError, TypeError, OverflowError, IndexError, EnvironmentError) as e:
+			print("[EPGImport][EventRecorder] Not caching this source:", e, file=log)
+			self.failed = True
+
+	def record(self, iterator):
+		"""Passes on the items of iterator while collecting the events"""
+		for item in iterator:
+			if item is not None:
+				self.add(*item)
+			yield item
+
+	def close(self):
+		"""Completes the file, returns False when it is not usable"""
+		try:
+			if not self.failed:
+				self.writeBlock()
+				# end marker, a file without it was not completed
+				dump(None, self.file, HIGHEST_PROTOCOL)
+		except EnvironmentError as e:
+			print("[EPGImport][EventRecorder] Failed to write events:", e, file=log)
+			self.failed = True
+		self.file.close()
+		return not self.failed
+
+
+class EventCache:
+	"""Directory of recorded sources, one file per cache key. Only the
+	CACHE_FILES most recently used files are kept."""
+
+	def __init__(self, directory):
+		self.directory = directory
+
+	def filename(self, key):
+		return join(self.directory, key + ".events")
+
+	def recorder(self, key):
+		"""Returns an EventRecorder for key, None if it cannot be created"""
+		try:
+			if not isdir(self.directory):
+				makedirs(self.directory)
+			return EventRecorder(self.filename(key) + ".tmp")
+		except Exception as e:
+			print("[EPGImport][EventCache] Cannot record events:", e, file=log)
+			return None
+
+	def store(self, key, recorder):
+		filename = self.filename(key)
+		try:
+			if recorder.close():
+				rename(recorder.filename, filename)
+				print("[EPGImport][EventCache] Stored events in", filename, file=log)
+			else:
+				remove(recorder.filename)
+				return
+		except Exception as e:
+			print("[EPGImport][EventCache] Failed to store events:", e, file=log)
+			return
+		self.trim()
+
+	def discard(self, recorder):
+		"""Removes the file of a recording that did not complete"""
+		recorder.failed = True
+		recorder.close()
+		try:
+			remove(recorder.filename)
+		except Exception:
+			pass
+
+	def load(self, key):
+		"""Returns the recorded file of key opened for replay, None if there is none"""
+		filename = self.filename(key)
+		if not exists(filename):
+			return None
+		f = None
+		try:
+			f = open(filename, "rb")
+			version = load(f)
+			if version != CACHE_VERSION:
+				raise ValueError("version %s" % version)
+			utime(filename, None)
+		except Exception as e:
+			print("[EPGImport][EventCache] Dropping unusable cache file:", e, file=log)
+			if f is not None:
+				f.close()
+			try:
+				remove(filename)
+			except Exception:
+				pass
+			return None
+		return f
+
+	def trim(self):
+		try:
+			files = [join(self.directory, name) for name in listdir(self.directory) if name.endswith(".events")]
+			files.sort(key=getmtime, reverse=True)
+			for filename in files[CACHE_FILES:]:
+				remove(filename)
+		except Exception as e:
+			print("[EPGImport][EventCache] Failed to clean up:", e, file=log)
+
+
+def replay(f):
+	"""Yields the (services, event) tuples of a file returned by load"""
+	print("[EPGImport][EventCache] Replaying cached events", file=log)
+	strings = []
+	try:
+		while True:
+			block = load(f)
+			if block is None:
+				break
+			reset, newStrings, services, starts, durations, categories, ratings, titles, subtitles, descriptions = block
+			if reset:
+				strings = []
+			strings.extend(newStrings)
+			for i in range(len(starts)):
+				event = (starts[i], durations[i], strings[titles[i]], strings[subtitles[i]], strings[descriptions[i]], categories[i])
+				if ratings[i] != NO_RATING:
+					event += (0, [("eng", ratings[i])])
+				yield (services, event)
+	except Exception as e:
+		print("[EPGImport][EventCache] Cache file broken off:", e, file=log)
+	finally:
+		f.close()
@@ -36,9 +36,9 @@ def new():
 
 
 class Gen_Xmltv():
-	def iterator(self, fd, channelsDict, offset=0):
+	def iterator(self, fd, channelsDict, offset=0, **options):
 		try:
-			xmltv_parser = xmltvconverter.XMLTVConverter(channelsDict, gen_categories, date_format, offset)
+			xmltv_parser = xmltvconverter.XMLTVConverter(channelsDict, gen_categories, date_format, offset, **options)
 			for r in xmltv_parser.enumFile(fd):
 				yield r
 		except Exception as e:
@@ -0,0 +1,174 @@
+# Mirror selection for the XMLTV importer
+#
+# Keeps the latency and throughput of past downloads per host, so an import
+# starts with the mirror that was fastest before instead of a random one.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import threading
+from pickle import dump, load, HIGHEST_PROTOCOL
+from random import shuffle
+from time import time
+
+try:
+	from urllib.parse import urlparse
+except ImportError:
+	from urlparse import urlparse
+
+try:
+	from queue import Queue, Empty
+except ImportError:
+	from Queue import Queue, Empty
+
+from requests import Session
+from requests.exceptions import RequestException
+
+from . import log
+
+STATS_FILE = "/etc/epgimport/mirrorstats.pkl"
+# Weight of the newest measurement in the running averages
+SMOOTHING = 0.3
+# File size used to turn latency and throughput into an expected download time
+REFERENCE_SIZE = 20 * 1024 * 1024
+# Expected time lost on a failing mirror (the download timeout)
+FAILURE_PENALTY = 15.0
+# Number of best ranked mirrors raced against each other
+RACE_CANDIDATES = 3
+RACE_TIMEOUT = 5
+
+
+def getHost(url):
+	return urlparse(url).netloc.lower()
+
+
+class MirrorStats:
+	"""Per host download statistics. Every entry is a dict with the keys
+	latency (seconds until the response headers arrived), speed (bytes/sec),
+	failures and updated."""
+
+	def __init__(self, filename=STATS_FILE):
+		self.filename = filename
+		# downloads run in threads
+		self.mutex = threading.Lock()
+		self.hosts = {}
+		self.load()
+
+	def load(self):
+		try:
+			with open(self.filename, "rb") as f:
+				self.hosts = load(f)
+		except Exception as e:
+			print("[EPGImport][MirrorStats] No mirror statistics", e, file=log)
+			self.hosts = {}
+
+	def save(self):
+		with self.mutex:
+			try:
+				with open(self.filename, "wb") as f:
+					dump(self.hosts, f, HIGHEST_PROTOCOL)
+			except Exception as e:
+				print("[EPGImport][MirrorStats] Failed to save mirror statistics", e, file=log)
+
+	def entry(self, url):
+		host = getHost(url)
+		entry = self.hosts.get(host)
+		if entry is None:
+			entry = self.hosts[host] = {"latency": None, "speed": None, "failures": 0, "updated": 0}
+		return entry
+
+	def recordLatency(self, url, latency):
+		with self.mutex:
+			entry = self.entry(url)
+			if entry["latency"] is None:
+				entry["latency"] = latency
+			else:
+				entry["latency"] += SMOOTHING * (latency - entry["latency"])
+			entry["updated"] = time()
+
+	def record(self, url, latency, size, seconds):
+		"""Records a successful download of size bytes"""
+		self.recordLatency(url, latency)
+		if size <= 0:
+			return
+		speed = size / max(seconds - latency, 0.001)
+		with self.mutex:
+			entry = self.entry(url)
+			if entry["speed"] is None:
+				entry["speed"] = speed
+			else:
+				entry["speed"] += SMOOTHING * (speed - entry["speed"])
+			entry["failures"] //= 2
+
+	def recordFailure(self, url):
+		with self.mutex:
+			entry = self.entry(url)
+			entry["failures"] += 1
+			entry["updated"] = time()
+
+	def expectedTime(self, url):
+		"""Expected seconds to download a reference file, None for unknown hosts"""
+		entry = self.hosts.get(getHost(url))
+		if entry is None or entry["latency"] is None:
+			return None
+		expected = entry["latency"] + entry["failures"] * FAILURE_PENALTY
+		if entry["speed"]:
+			expected += REFERENCE_SIZE / entry["speed"]
+		return expected
+
+	def rank(self, urls):
+		"""Returns urls ordered from the most to the least promising mirror.
+		Hosts without statistics come first, so they get measured once, and
+		hosts that failed without ever answering come last."""
+		unknown = []
+		known = []
+		failing = []
+		with self.mutex:
+			for url in urls:
+				entry = self.hosts.get(getHost(url))
+				if entry is None or (entry["latency"] is None and not entry["failures"]):
+					unknown.append(url)
+				elif entry["latency"] is None:
+					failing.append((entry["failures"], url))
+				else:
+					known.append((self.expectedTime(url), url))
+		shuffle(unknown)
+		known.sort(key=lambda item: item[0])
+		failing.sort(key=lambda item: item[0])
+		return unknown + [url for expected, url in known] + [url for failures, url in failing]
+
+	def race(self, urls, urlheaders=None, session=None):
+		"""Sends HEAD requests to the best ranked urls at the same time and
+		returns the first one that answers. Blocks, so call it from a thread."""
+		candidates = self.rank(urls)[:RACE_CANDIDATES]
+		results = Queue()
+
+		def probe(url):
+			begin = time()
+			try:
+				s = session
+				if s is None:
+					s = Session()
+					s.headers = {}
+				response = s.head(url, verify=False, headers=urlheaders, timeout=RACE_TIMEOUT, allow_redirects=True)
+				response.raise_for_status()
+				self.recordLatency(url, time() - begin)
+				results.put(url)
+			except RequestException as e:
+				print("[EPGImport][MirrorStats] Mirror %s failed:" % url, e, file=log)
+				self.recordFailure(url)
+				results.put(None)
+
+		for url in candidates:
+			t = threading.Thread(target=probe, args=(url,))
+			t.daemon = True
+			t.start()
+		for i in range(len(candidates)):
+			try:
+				url = results.get(timeout=RACE_TIMEOUT + 1)
+			except Empty:
+				break
+			if url is not None:
+				print("[EPGImport][MirrorStats] Fastest mirror:", url, file=log)
+				return url
+		return candidates[0]
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, print_function
-from os import remove
-from os.path import exists, join
+from os import listdir, makedirs, remove
+from os.path import dirname, exists, getmtime, isdir, join
+from pickle import dump, load, HIGHEST_PROTOCOL
+from shutil import rmtree
 from time import localtime, mktime, strftime, strptime, time, asctime
 from enigma import eServiceCenter, eServiceReference, eEPGCache, eTimer, getDesktop, eConsoleAppContainer
 
@@ -10,6 +12,8 @@ from . import ExpandableSelectionList
 from . import filtersServices
 from . import EPGImport
 from . import EPGConfig
+from . import downloadcache
+from . import mirrors
 
 from Components.ActionMap import ActionMap
 from Components.Button import Button
@@ -63,6 +67,11 @@ BouquetChannelListList = None
 serviceIgnoreList = None
 filterCounter = 0
 isFilterRunning = 0
+# Verdicts of channelFilter by service ref, see loadFilterVerdicts
+filterVerdicts = None
+FILTER_VERDICTS_FILE = "/etc/epgimport/channelfilter.pkl"
+# Parsed channel files used to be kept on flash here
+OLD_CHANNEL_CACHE_PATH = "/etc/epgimport/cache"
 
 SOURCE_LINKS = {
 	"0": "https://github.com/doglover3920/EPGimport-Sources/archive/refs/heads/main.tar.gz",
@@ -114,6 +123,42 @@ config.plugins.epgimport.import_onlybouquet = ConfigYesNo(default=False)
 config.plugins.epgimport.import_onlyiptv = ConfigYesNo(default=False)
 config.plugins.epgimport.clear_oldepg = ConfigYesNo(default=False)
 config.plugins.epgimport.filter_custom_channel = ConfigYesNo(default=True)
+config.plugins.epgimport.pipeline_download = ConfigYesNo(default=False)
+config.plugins.epgimport.download_cache = ConfigYesNo(default=False)
+config.plugins.epgimport.download_cache_size = ConfigInteger(default=50, limits=(10, 2000))
+config.plugins.epgimport.prefetch_downloads = ConfigSelection(
+	default="0",
+	choices=[
+		("0", _("disabled")),
+		("1", "1"),
+		("2", "2"),
+		("3", "3")
+	]
+)
+config.plugins.epgimport.mirror_race = ConfigYesNo(default=False)
+config.plugins.epgimport.event_cache = ConfigYesNo(default=False)
+config.plugins.epgimport.differential_import = ConfigYesNo(default=False)
+config.plugins.epgimport.import_days = ConfigInteger(default=0, limits=(0, 31))
+config.plugins.epgimport.skip_past_events = ConfigYesNo(default=False)
+config.plugins.epgimport.parser_backend = ConfigSelection(
+	default="etree",
+	choices=[
+		("etree", _("ElementTree")),
+		("expat", _("Expat (faster)"))
+	]
+)
+config.plugins.epgimport.parse_workers = ConfigSelection(
+	default="1",
+	choices=[
+		("1", _("disabled")),
+		("2", "2"),
+		("3", "3"),
+		("4", "4")
+	]
+)
+config.plugins.epgimport.preferred_languages = ConfigText(default="nl", fixed_size=False)
+config.plugins.epgimport.http_pool_size = ConfigInteger(default=EPGImport.HTTP_POOL_SIZE, limits=(1, 50))
+config.plugins.epgimport.import_batch_size = ConfigInteger(default=EPGImport.IMPORT_BATCH_SIZE, limits=(1, 10000))
 config.plugins.epgimport.day_profile = ConfigSelection(choices=[("1", _("Press OK"))], default="1")
 config.plugins.extra_epgimport = ConfigSubsection()
 config.plugins.extra_epgimport.last_import = ConfigText(default="0")
@@ -148,7 +193,7 @@ def getRefNum(ref):
 
 
 def getBouquetChannelList():
-	channels = []
+	channels = set()
 	global isFilterRunning, filterCounter
 	isFilterRunning = 1
 	serviceHandler = eServiceCenter.getInstance()
@@ -179,12 +224,12 @@ def getBouquetChannelList():
 										if alternative_list:
 											for channel in alternative_list:
 												refnum = getRefNum(channel)
-												if refnum and refnum not in channels:
-													channels.append(refnum)
+												if refnum:
+													channels.add(refnum)
 									else:
 										refnum = getRefNum(service.toString())
-										if refnum and refnum not in channels:
-											channels.append(refnum)
+										if refnum:
+											channels.add(refnum)
 	else:
 		bouquet_rootstr = '1:7:1:0:0:0:0:0:0:0:FROM BOUQUET "userbouquet.favourites.tv" ORDER BY bouquet'
 		bouquet_root = eServiceReference(bouquet_rootstr)
@@ -201,20 +246,134 @@ def getBouquetChannelList():
 						if alternative_list:
 							for channel in alternative_list:
 								refnum = getRefNum(channel)
-								if refnum and refnum not in channels:
-									channels.append(refnum)
+								if refnum:
+									channels.add(refnum)
 					else:
 						refnum = getRefNum(service.toString())
-						if refnum and refnum not in channels:
-							channels.append(refnum)
+						if refnum:
+							channels.add(refnum)
 	isFilterRunning = 0
 	return channels
 
 
-# Filter servicerefs that this box can display by starting a fake recording.
+class BouquetIndex:
+	"""Set of the ref numbers of all services in the bouquets. It is only
+	rebuilt when a bouquet file or the bouquet mode changed."""
+
+	def __init__(self):
+		self.refnums = set()
+		self.signature = None
+		self.buildTime = 0
+
+	def get(self):
+		signature = (config.usage.multibouquet.value, bouquetFilesSignature())
+		if signature != self.signature:
+			begin = time()
+			self.refnums = getBouquetChannelList()
+			self.buildTime = time() - begin
+			self.signature = signature
+			print("[EPGImport] Bouquet index built: %d services in %.2fs" % (len(self.refnums), self.buildTime), file=log)
+		return self.refnums
+
+
+bouquetIndex = BouquetIndex()
+
+
+def bouquetFilesSignature():
+	"""Names and modification times of the bouquet files"""
+	files = []
+	try:
+		for name in sorted(listdir("/etc/enigma2")):
+			if name.startswith(("bouquets.", "userbouquet.", "alternatives.")):
+				files.append((name, getmtime(join("/etc/enigma2", name))))
+	except Exception as e:
+		print("[EPGImport] bouquetFilesSignature error:", e, file=log)
+	return files
+
+
+def channelFilterSignature():
+	"""Everything the verdicts of channelFilter depend on, see EPGConfig.channelFilterSignature"""
+	signature = [
+		config.plugins.epgimport.import_onlyiptv.value,
+		config.plugins.epgimport.import_onlybouquet.value,
+		config.usage.multibouquet.value,
+		filtersServices.filtersServicesList.servicesList(),
+	]
+	if config.plugins.epgimport.import_onlybouquet.value:
+		signature.append(bouquetFilesSignature())
+	try:
+		signature.append(getmtime("/etc/enigma2/lamedb"))
+	except OSError:
+		signature.append(None)
+	signature.append(tunerSignature())
+	return repr(signature)
+
+
+def tunerSignature():
+	"""Tuner configuration, it decides which services a fake recording can tune"""
+	try:
+		from Components.NimManager import nimmanager
+		nims = [(nim.slot, getattr(nim, "type", None)) for nim in nimmanager.nim_slots]
+	except Exception:
+		nims = None
+	try:
+		nimConfig = config.Nims.saved_value
+	except Exception:
+		nimConfig = None
+	return repr((nims, nimConfig))
+
+
+EPGConfig.channelFilterSignature = channelFilterSignature
+
+
+def loadFilterVerdicts():
+	"""Loads the verdicts of channelFilter from previous imports, they are
+	dropped when lamedb, the bouquets, the tuners or the filter options changed"""
+	global filterVerdicts
+	signature = channelFilterSignature()
+	try:
+		with open(FILTER_VERDICTS_FILE, "rb") as f:
+			stored = load(f)
+		if stored["signature"] == signature:
+			filterVerdicts = stored
+			print("[EPGImport] Loaded %d channel filter verdicts" % len(stored["verdicts"]), file=log)
+			return
+		print("[EPGImport] Channel filter verdicts are outdated", file=log)
+	except Exception as e:
+		print("[EPGImport] No channel filter verdicts", e, file=log)
+	filterVerdicts = {"signature": signature, "verdicts": {}}
+
+
+def saveFilterVerdicts():
+	global filterVerdicts
+	if filterVerdicts is None:
+		return
+	try:
+		if isdir(OLD_CHANNEL_CACHE_PATH):
+			rmtree(OLD_CHANNEL_CACHE_PATH, ignore_errors=True)
+		if not isdir(dirname(FILTER_VERDICTS_FILE)):
+			makedirs(dirname(FILTER_VERDICTS_FILE))
+		with open(FILTER_VERDICTS_FILE, "wb") as f:
+			dump(filterVerdicts, f, HIGHEST_PROTOCOL)
+	except Exception as e:
+		print("[EPGImport] Failed to save channel filter verdicts", e, file=log)
+	filterVerdicts = None
 
 
 def channelFilter(ref):
+	if filterVerdicts is None:
+		return checkChannel(ref)
+	verdicts = filterVerdicts["verdicts"]
+	verdict = verdicts.get(ref)
+	if verdict is None:
+		verdict = verdicts[ref] = checkChannel(ref)
+	return verdict
+
+
+# Filter servicerefs that this box can display by starting a fake recording.
+
+
+def checkChannel(ref):
 	if not ref:
 		return False
 	# Ignore non IPTV
@@ -225,7 +384,7 @@ def channelFilter(ref):
 	if config.plugins.epgimport.import_onlybouquet.value:
 		global BouquetChannelListList
 		if BouquetChannelListList is None:
-			BouquetChannelListList = getBouquetChannelList()
+			BouquetChannelListList = bouquetIndex.get()
 		if refnum not in BouquetChannelListList:
 			print("Serviceref not in bouquets:", sref.toString(), file=log)
 			return False
@@ -260,6 +419,11 @@ except Exception as e:
 lastImportResult = None
 
 
+def preferredLanguages():
+	"""The language codes of the setting, most preferred first"""
+	return config.plugins.epgimport.preferred_languages.value.replace(",", " ").split()
+
+
 def startImport():
 	if not epgimport.isImportRunning():
 		EPGImport.HDD_EPG_DAT = config.misc.epgcache_filename.value
@@ -268,6 +432,27 @@ def startImport():
 			EPGImport.unlink_if_exists(EPGImport.HDD_EPG_DAT + ".backup")
 			epgimport.epgcache.flushEPG()
 		epgimport.onDone = doneImport
+		loadFilterVerdicts()
+		epgimport.pipelineDownload = config.plugins.epgimport.pipeline_download.value
+		if config.plugins.epgimport.download_cache.value:
+			epgimport.downloadCache = downloadcache.DownloadCache(maxSize=config.plugins.epgimport.download_cache_size.value * 1024 * 1024)
+		else:
+			epgimport.downloadCache = None
+		epgimport.prefetchWorkers = int(config.plugins.epgimport.prefetch_downloads.value)
+		epgimport.mirrorStats = mirrors.MirrorStats()
+		epgimport.raceMirrors = config.plugins.epgimport.mirror_race.value
+		epgimport.poolSize = config.plugins.epgimport.http_pool_size.value
+		epgimport.batchSize = config.plugins.epgimport.import_batch_size.value
+		epgimport.eventCache = config.plugins.epgimport.event_cache.value
+		epgimport.parserOptions = {"backend": config.plugins.epgimport.parser_backend.value, "languages": preferredLanguages(), "workers": int(config.plugins.epgimport.parse_workers.value)}
+		now = time()
+		if config.plugins.epgimport.skip_past_events.value:
+			epgimport.parserOptions["windowStart"] = now
+		if config.plugins.epgimport.import_days.value:
+			epgimport.parserOptions["windowEnd"] = now + config.plugins.epgimport.import_days.value * 24 * 3600
+		# with a flushed epgcache unchanged sources must be imported again
+		epgimport.skipUnchanged = not config.plugins.epgimport.clear_oldepg.value
+		epgimport.differential = config.plugins.epgimport.differential_import.value and not config.plugins.epgimport.clear_oldepg.value
 		epgimport.beginImport(longDescUntil=config.plugins.epgimport.longDescDays.value * 24 * 3600 + time())
 	else:
 		print("[startImport] Already running, won't start again", file=log)
@@ -364,6 +549,7 @@ class EPGImportConfig(ConfigListScreen, Screen):
 		self.createSetup()
 		self.filterStatusTemplate = _("Filtering:\n%s Please wait!")
 		self.importStatusTemplate = _("Importing:\n%s %s events")
+		self.bouquetIndexTemplate = _("Bouquet index:\n%d services, built in %.1f s")
 		self.updateTimer = eTimer()
 		self.updateTimer.callback.append(self.updateStatus)
 		self.updateTimer.start(2000)
@@ -424,6 +610,18 @@ class EPGImportConfig(ConfigListScreen, Screen):
 		self.cfg_parse_autotimer = getConfigListEntry(_("Run AutoTimer after import"), self.EPG.parse_autotimer, _("You can start automatically the plugin AutoTimer after the EPG data update to have it refreshing its scheduling after EPG data refresh."))
 		self.cfg_clear_oldepg = getConfigListEntry(_("Delete current EPG before import"), config.plugins.epgimport.clear_oldepg, _("This will clear the current EPG data in memory before updating the EPG data. This allows you to always have a clean new EPG with the latest EPG data, for example in case of program changes between refresh, otherwise EPG data are cumulative."))
 		self.cfg_filter_custom_channel = getConfigListEntry(_("Also apply \"channel id\" filtering on custom.channels.xml"), self.EPG.filter_custom_channel, _("This is for advanced users that are using the channel id filtering feature. If enabled, the filter rules defined into /etc/epgimport/channel_id_filter.conf will also be applied on your /etc/epgimport/custom.channels.xml file."))
+		self.cfg_pipeline_download = getConfigListEntry(_("Decompress and import while downloading"), self.EPG.pipeline_download, _("When enabled, compressed sources are uncompressed and imported while they are downloaded, without storing a temporary file on HDD, USB or flash."))
+		self.cfg_download_cache = getConfigListEntry(_("Skip sources that did not change"), self.EPG.download_cache, _("When enabled, downloaded files are kept in a cache and the server is asked whether a source changed since the last import. Unchanged sources are not downloaded and imported again."))
+		self.cfg_download_cache_size = getConfigListEntry(dx + _("Maximum cache size (MB)"), self.EPG.download_cache_size, _("The oldest cached files are removed when the cache grows beyond this size."))
+		self.cfg_prefetch_downloads = getConfigListEntry(_("Download next sources in advance"), self.EPG.prefetch_downloads, _("Number of sources that are downloaded in the background while the current source is imported. This needs free space on HDD, USB or flash for the downloaded files."))
+		self.cfg_mirror_race = getConfigListEntry(_("Test mirrors before download"), self.EPG.mirror_race, _("When enabled, the fastest mirrors of a source are contacted at the same time and the download starts from the one that answers first. Otherwise the mirror that was fastest in the past is used."))
+		self.cfg_parser_backend = getConfigListEntry(_("XMLTV parser"), self.EPG.parser_backend, _("The expat parser skips the programmes of channels that are not used on this box without analysing them, which makes imports of large sources faster."))
+		self.cfg_import_days = getConfigListEntry(_("Import events up to X days (0 = all)"), self.EPG.import_days, _("Events that start later than this number of days are not imported. This saves memory and speeds up the import of sources that provide more days than you need."))
+		self.cfg_skip_past_events = getConfigListEntry(_("Skip events that already ended"), self.EPG.skip_past_events, _("When enabled, events that ended before the import started are not imported."))
+		self.cfg_differential_import = getConfigListEntry(_("Only import changed events"), self.EPG.differential_import, _("When enabled, events that were already imported since the receiver started are not imported again. Events that were removed from a source stay in the EPG until they expire. Not used when the current EPG is deleted before the import."))
+		self.cfg_event_cache = getConfigListEntry(_("Keep converted events of the last imports"), self.EPG.event_cache, _("When enabled, the events of the last imported files are kept in a compact form on HDD, USB or flash. When the same file is imported again, its events are loaded from there instead of analysing the XMLTV data again."))
+		self.cfg_parse_workers = getConfigListEntry(_("Parallel processes for parsing"), self.EPG.parse_workers, _("Number of processes that convert the XMLTV data at the same time. This speeds up the import on receivers with several processor cores, but uses more memory."))
+		self.cfg_preferred_languages = getConfigListEntry(_("Preferred languages"), self.EPG.preferred_languages, _("Language codes separated by commas, most preferred first, e.g. \"nl,en\". Sources that provide titles and descriptions in several languages are imported in the first available language of this list."))
 		self.cfg_execute_shell = getConfigListEntry(_("Execute shell command before import EPG"), self.EPG.execute_shell, _("When enabled, then you can run the desired script before starting the import, after which the import of the EPG will begin."))
 		self.cfg_shell_name = getConfigListEntry(dx + _("Shell command name"), self.EPG.shell_name, _("Enter shell command name."))
 
@@ -454,6 +652,21 @@ class EPGImportConfig(ConfigListScreen, Screen):
 			self.list.append(self.cfg_clear_oldepg)
 		self.list.append(self.cfg_filter_custom_channel)
 		self.list.append(self.cfg_longDescDays)
+		self.list.append(self.cfg_import_days)
+		self.list.append(self.cfg_skip_past_events)
+		self.list.append(self.cfg_pipeline_download)
+		if not self.EPG.pipeline_download.value:
+			self.list.append(self.cfg_prefetch_downloads)
+		self.list.append(self.cfg_mirror_race)
+		self.list.append(self.cfg_parser_backend)
+		self.list.append(self.cfg_parse_workers)
+		self.list.append(self.cfg_preferred_languages)
+		self.list.append(self.cfg_event_cache)
+		if not self.EPG.clear_oldepg.value:
+			self.list.append(self.cfg_differential_import)
+		self.list.append(self.cfg_download_cache)
+		if self.EPG.download_cache.value:
+			self.list.append(self.cfg_download_cache_size)
 		self.list.append(self.cfg_execute_shell)
 		if self.EPG.execute_shell.value:
 			self.list.append(self.cfg_shell_name)
@@ -469,7 +682,7 @@ class EPGImportConfig(ConfigListScreen, Screen):
 
 	def newConfig(self):
 		cur = self["config"].getCurrent()
-		if cur in (self.cfg_enabled, self.cfg_shutdown, self.cfg_deepstandby, self.cfg_runboot, self.cfg_import_onlyiptv, self.cfg_execute_shell):
+		if cur in (self.cfg_enabled, self.cfg_shutdown, self.cfg_deepstandby, self.cfg_runboot, self.cfg_import_onlyiptv, self.cfg_execute_shell, self.cfg_pipeline_download, self.cfg_download_cache, self.cfg_clear_oldepg):
 			self.createSetup()
 		self.setInfo()
 
@@ -596,6 +809,8 @@ class EPGImportConfig(ConfigListScreen, Screen):
 		elif epgimport.isImportRunning():
 			src = epgimport.source
 			text = self.importStatusTemplate % (src.description, epgimport.eventCount)
+		elif bouquetIndex.signature is not None:
+			text = self.bouquetIndexTemplate % (len(bouquetIndex.refnums), bouquetIndex.buildTime)
 		self["status"].setText(text)
 		if lastImportResult and (lastImportResult != self.lastImportResult):
 			start, count = lastImportResult
@@ -1037,6 +1252,7 @@ def doneImport(reboot=False, epgfile=None):
 	global _session, lastImportResult, BouquetChannelListList, serviceIgnoreList
 	BouquetChannelListList = None
 	serviceIgnoreList = None
+	saveFilterVerdicts()
 	timestamp = time()
 	formatted_time = strftime("%Y-%m-%d %H:%M:%S", localtime(timestamp))
 	lastImportResult = (formatted_time, epgimport.eventCount)
@@ -1,12 +1,26 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from xml.etree.cElementTree import iterparse
-from xml.sax.saxutils import unescape
-from calendar import timegm
-from time import strptime, struct_time
+from xml.etree.cElementTree import iterparse, TreeBuilder
+from xml.parsers.expat import ParserCreate
+from collections import deque
+from io import BytesIO
+from os import devnull
+from os.path import abspath, basename, dirname, exists, join
+from pickle import dump, load, HIGHEST_PROTOCOL
+from re import compile
+from subprocess import PIPE, Popen
+import sys
+import threading
+from time import strptime, time
 
 from . import log
+from .xmltvtime import get_time_utc, quickptime
+
+try:
+	from queue import Queue
+except ImportError:
+	from Queue import Queue
 
 try:
 	basestring
@@ -14,37 +28,31 @@ except NameError:
 	basestring = str
 
 
-def quickptime(date_str):
-	return struct_time(
-		(
-			int(date_str[0:4]),     # Year
-			int(date_str[4:6]),     # Month
-			int(date_str[6:8]),     # Day
-			int(date_str[8:10]),    # Hour
-			int(date_str[10:12]),   # Minute
-			0,                      # Second (set to 0)
-			-1,                     # Weekday (set to -1 as unknown)
-			-1,                     # Julian day (set to -1 as unknown)
-			0                       # DST (Daylight Saving Time, set to 0 as unknown)
-		)
-	)
-
-
-def get_time_utc(timestring, fdateparse):
-	# print("get_time_utc", timestring, format)
-	try:
-		values = timestring.split(" ")
-		tm = fdateparse(values[0])
-		time_gm = timegm(tm)
-		# suppose file says +0300 => that means we have to substract 3 hours from localtime to get GMT
-		time_gm -= (3600 * int(values[1]) // 100)
-		return time_gm
-	except Exception as e:
-		print("[XMLTVConverter] get_time_utc error:", e)
-		return 0
+# Entities left in the text by the XML parser, decoded in a single pass.
+# Note that the default xml.sax.saxutils.unescape() function don't unescape
+# some characters, so they were always added to its entities dictionary.
+ENTITIES = {
+	"&lt;": "<",
+	"&gt;": ">",
+	"&amp;": "&",
+	"&apos;": "'",
+	"&quot;": '"',
+	"&#124;": "|",
+	"&nbsp;": " ",
+	"&#91;": "[",
+	"&#93;": "]",
+}
+entityPattern = compile("|".join(ENTITIES))
+
+
+def decode_entities(text, lookup=ENTITIES.__getitem__):
+	if "&" not in text:
+		return text
+	return entityPattern.sub(lambda m: lookup(m.group()), text)
 
-# Preferred language should be configurable, but for now,
-# we just like Dutch better!
+
+# Kept for other users, XMLTVConverter has a configurable language priority.
+# Here we just like Dutch better!
 
 
 def get_xml_string(elem, name):
@@ -61,17 +69,8 @@ def get_xml_string(elem, name):
 		print("[XMLTVConverter] get_xml_string error:", e)
 	"""
 	# Now returning UTF-8 by default, the epgdat/oudeis must be adjusted to make this work.
-	# Note that the default xml.sax.saxutils.unescape() function don't unescape
-	# some characters and we have to manually add them to the entities dictionary.
 	"""
-	r = unescape(r, entities={
-		r"&apos;": r"'",
-		r"&quot;": r'"',
-		r"&#124;": r"|",
-		r"&nbsp;": r" ",
-		r"&#91;": r"[",
-		r"&#93;": r"]",
-	})
+	r = decode_entities(r)
 	return r.decode() if isinstance(r, bytes) else r
 
 
@@ -88,6 +87,60 @@ def get_xml_rating_string(elem):
 	return r.decode() if isinstance(r, bytes) else r
 
 
+# Child elements of a programme that are converted to event texts
+TEXT_TAGS = frozenset(("title", "sub-title", "desc", "category"))
+
+
+def languageRanks(languages):
+	"""Resolves a list of language codes, most preferred first, into a
+	table of ranks. Languages that are not listed get rank len(table)."""
+	ranks = {}
+	for lang in languages:
+		if lang not in ranks:
+			ranks[lang] = len(ranks)
+	return ranks
+
+
+DEFAULT_LANGUAGE_RANKS = languageRanks(("nl",))
+
+
+def pickText(texts, chosen, tag, txt, rank, unranked):
+	"""Keeps txt as the text of tag if it is better than the one in texts.
+	The first text is kept unless a listed language of the same or a better
+	rank follows, like get_xml_string does for "nl"."""
+	if not texts.get(tag) and txt is not None:
+		texts[tag] = txt
+		chosen[tag] = rank
+	elif rank < unranked and rank <= chosen.get(tag, unranked):
+		texts[tag] = txt
+		chosen[tag] = rank
+
+
+def get_xml_texts(elem, ranks=DEFAULT_LANGUAGE_RANKS):
+	"""Walks the children of a programme once. Returns a dict with the raw
+	preferred text of every tag in TEXT_TAGS and the rating string of
+	get_xml_rating_string."""
+	texts = {}
+	chosen = {}
+	unranked = len(ranks)
+	rating = ""
+	ratingDone = False
+	for node in elem:
+		tag = node.tag
+		if tag in TEXT_TAGS:
+			pickText(texts, chosen, tag, node.text, ranks.get(node.get("lang"), unranked), unranked)
+		elif tag == "rating" and not ratingDone:
+			for val in node.findall("value"):
+				txt = val.text
+				if txt is None:
+					# get_xml_rating_string stops at the first empty value
+					ratingDone = True
+					break
+				if not rating:
+					rating = txt.replace("+", "")
+	return texts, rating
+
+
 def enumerateProgrammes(fp):
 	"""Enumerates programme ElementTree nodes from file object 'fp'"""
 	for event, elem in iterparse(fp):
@@ -102,68 +155,555 @@ def enumerateProgrammes(fp):
 			print("[XMLTVConverter] enumerateProgrammes error:", e)
 
 
+# Size of the blocks fed to the expat parser
+EXPAT_CHUNK_SIZE = 65536
+
+
+def enumerateMappedProgrammes(fp, channels, unknown=None, ranks=DEFAULT_LANGUAGE_RANKS, window=None):
+	"""Enumerates (services, element) for the programmes of the channels in
+	'channels' from file object 'fp'. Uses expat directly and swaps the
+	handlers per state, so programmes of other channels are skipped on their
+	start tag without building elements or even seeing their text. Text
+	nodes in a language that get_xml_texts would not pick with 'ranks' are
+	dropped in the same way. unknown(channel) is called for every skipped
+	programme. window(start, stop), if given, is called with the attributes
+	of every mapped programme and programmes it rejects are skipped too.
+	Yields None after every block without mapped programmes, to give up time
+	to the reactor."""
+	programmes = []
+	parser = ParserCreate()
+	parser.buffer_text = True
+	unranked = len(ranks)
+	# services, builder, open children, dropped open elements
+	current = [None, None, 0, 0]
+	texts = {}
+	chosen = {}
+
+	def outsideStart(tag, attrs):
+		if tag == "programme":
+			channel = attrs.get("channel", "").lower()
+			services = channels.get(channel)
+			if services is None:
+				if unknown is not None:
+					unknown(channel)
+			elif window is None or window(attrs.get("start"), attrs.get("stop")):
+				builder = TreeBuilder()
+				builder.start(tag, attrs)
+				current[0] = services
+				current[1] = builder
+				current[2] = 0
+				texts.clear()
+				chosen.clear()
+				parser.StartElementHandler = programmeStart
+				parser.EndElementHandler = programmeEnd
+				parser.CharacterDataHandler = builder.data
+				return
+		elif tag != "channel":
+			return
+		# Skip the unmapped or rejected programme or the channel element, these do not nest
+		parser.StartElementHandler = None
+		parser.EndElementHandler = skippedEnd
+
+	def skippedEnd(tag):
+		if tag == "programme" or tag == "channel":
+			parser.StartElementHandler = outsideStart
+			parser.EndElementHandler = None
+
+	def programmeStart(tag, attrs):
+		depth = current[2] + 1
+		if depth == 1 and texts.get(tag):
+			# a text node that pickText can never keep is not built
+			rank = ranks.get(attrs.get("lang"), unranked)
+			if rank == unranked or rank > chosen[tag]:
+				current[3] = 1
+				parser.StartElementHandler = droppedStart
+				parser.EndElementHandler = droppedEnd
+				parser.CharacterDataHandler = None
+				return
+		current[2] = depth
+		current[1].start(tag, attrs)
+
+	def programmeEnd(tag):
+		builder = current[1]
+		elem = builder.end(tag)
+		depth = current[2]
+		current[2] = depth - 1
+		if depth == 1:
+			if tag in TEXT_TAGS:
+				pickText(texts, chosen, tag, elem.text, ranks.get(elem.get("lang"), unranked), unranked)
+		elif tag == "programme" and not depth:
+			programmes.append((current[0], builder.close()))
+			parser.StartElementHandler = outsideStart
+			parser.EndElementHandler = None
+			parser.CharacterDataHandler = None
+
+	def droppedStart(tag, attrs):
+		current[3] += 1
+
+	def droppedEnd(tag):
+		current[3] -= 1
+		if not current[3]:
+			parser.StartElementHandler = programmeStart
+			parser.EndElementHandler = programmeEnd
+			parser.CharacterDataHandler = current[1].data
+
+	parser.StartElementHandler = outsideStart
+	while True:
+		block = fp.read(EXPAT_CHUNK_SIZE)
+		parser.Parse(block, not block)
+		if programmes:
+			for programme in programmes:
+				yield programme
+			del programmes[:]
+		elif block:
+			yield None
+		if not block:
+			break
+
+
+# Size of the XML chunks converted by the worker processes
+PARALLEL_CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for a chunk before the rest is parsed in this process
+PARALLEL_TIMEOUT = 60
+PROGRAMME_START = b"<programme"
+PROGRAMME_END = b"</programme>"
+# Script run by the worker processes of ParserPool
+WORKER_SCRIPT = join(dirname(abspath(__file__)), "xmltvworker.py")
+
+
+class PrefixReader:
+	"""File object that returns data before the rest of fileobj"""
+
+	def __init__(self, data, fileobj):
+		self.data = data
+		self.fileobj = fileobj
+
+	def read(self, size=-1):
+		if not self.data:
+			return self.fileobj.read(size)
+		if size is None or size < 0:
+			data = self.data + self.fileobj.read()
+			self.data = b""
+		else:
+			data = self.data[:size]
+			self.data = self.data[size:]
+		return data
+
+
+def readHead(fp, size=PARALLEL_CHUNK_SIZE):
+	"""Reads fp up to its first programme. Returns that data and a file
+	object that reads all of fp, the data included."""
+	data = b""
+	while True:
+		block = fp.read(size)
+		start = max(len(data) - len(PROGRAMME_START), 0)
+		data += block
+		if not block or data.find(PROGRAMME_START, start) >= 0:
+			return data, PrefixReader(data, fp)
+
+
+def hasInternalSubset(head):
+	"""Tells whether the document that starts with head has a DOCTYPE with
+	an internal subset, whose entities the chunks of splitProgrammes lack"""
+	first = head.find(PROGRAMME_START)
+	doctype = head.find(b"<!DOCTYPE", 0, first if first >= 0 else len(head))
+	if doctype < 0:
+		return False
+	subset = head.find(b"[", doctype)
+	return subset >= 0 and subset < head.find(b">", doctype)
+
+
+def splitProgrammes(fp, size=PARALLEL_CHUNK_SIZE):
+	"""Splits the XMLTV document in file object 'fp' at </programme>
+	boundaries into small documents of about 'size' bytes. Every document
+	keeps the xml declaration, for the encoding, and wraps its programmes in
+	a <tv> element. The channel elements and the DOCTYPE before the first
+	programme are dropped, see hasInternalSubset."""
+	head = None
+	data = b""
+	while True:
+		block = fp.read(size)
+		data += block
+		if head is None:
+			first = data.find(b"<programme")
+			if first < 0:
+				if not block:
+					return
+				continue
+			head = b""
+			declaration = data.find(b"<?xml", 0, first)
+			if declaration >= 0:
+				head = data[declaration:data.find(b"?>", declaration) + 2]
+			data = data[first:]
+		if len(data) >= size or not block:
+			end = data.rfind(PROGRAMME_END)
+			if end >= 0:
+				end += len(PROGRAMME_END)
+				yield head + b"<tv>" + data[:end] + b"</tv>"
+				data = data[end:]
+		if not block:
+			if b"<programme" in data:
+				print("[XMLTVConverter] Incomplete programme at the end of the file", file=log)
+			return
+
+
+# The converter of a worker process, see initWorker
+workerConverter = None
+
+
+def initWorker(channels, categories, dateformat, offset, backend, languages, windowStart, windowEnd):
+	"""Creates the converter of a worker process. Its channels map to the
+	channel id itself, so the results do not carry the service lists."""
+	global workerConverter, log
+	# stdout carries the results, nobody reads the messages of a worker
+	log = sys.stdout = sys.stderr = open(devnull, "w")
+	workerConverter = XMLTVConverter(dict((channel, channel) for channel in channels), categories, dateformat, offset, backend, languages, windowStart=windowStart, windowEnd=windowEnd)
+
+
+def convertChunk(chunk):
+	"""Returns the (channel id, event) tuples of a splitProgrammes chunk"""
+	return [event for event in workerConverter.enumSerial(BytesIO(chunk)) if event is not None]
+
+
+def workerPython():
+	"""The Python interpreter for the worker processes, enigma2 embeds
+	Python so sys.executable may not be one"""
+	if sys.executable and basename(sys.executable).startswith("python"):
+		return sys.executable
+	python = join(sys.exec_prefix, "bin", "python%d" % sys.version_info[0])
+	return python if exists(python) else None
+
+
+class WorkerResult:
+	"""The answer of a worker process to one chunk, like the AsyncResult
+	of multiprocessing"""
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.value = None
+		self.error = None
+
+	def set(self, value=None, error=None):
+		self.value = value
+		self.error = error
+		self.event.set()
+
+	def wait(self, timeout=None):
+		self.event.wait(timeout)
+
+	def ready(self):
+		return self.event.is_set()
+
+	def get(self):
+		self.event.wait()
+		if self.error is not None:
+			raise Exception(self.error)
+		return self.value
+
+
+class WorkerProcess:
+	"""A worker process of ParserPool. Messages are written to its stdin
+	by a thread, so a busy worker does not block the caller, and its answers
+	are read from its stdout by another one. It answers every chunk in
+	order."""
+
+	def __init__(self, python):
+		self.process = Popen([python, WORKER_SCRIPT], stdin=PIPE, stdout=PIPE, close_fds=True)
+		self.mutex = threading.Lock()
+		self.pending = deque()
+		self.messages = Queue()
+		for target in (self.writer, self.reader):
+			thread = threading.Thread(target=target)
+			thread.daemon = True
+			thread.start()
+
+	def send(self, message, result=None):
+		if result is not None:
+			with self.mutex:
+				if self.process is None:
+					result.set(error="Worker process stopped")
+					return
+				self.pending.append(result)
+		self.messages.put(message)
+
+	def writer(self):
+		stdin = self.process.stdin
+		try:
+			while True:
+				message = self.messages.get()
+				if message is None:
+					break
+				dump(message, stdin, HIGHEST_PROTOCOL)
+				stdin.flush()
+		except Exception as e:
+			print("[XMLTVConverter] Cannot write to worker process:", e, file=log)
+		try:
+			stdin.close()
+		except Exception:
+			pass
+
+	def reader(self):
+		stdout = self.process.stdout
+		while True:
+			try:
+				ok, value = load(stdout)
+			except Exception:
+				break
+			with self.mutex:
+				result = self.pending.popleft() if self.pending else None
+			if result is not None:
+				if ok:
+					result.set(value)
+				else:
+					result.set(error=value)
+		self.stop()
+		with self.mutex:
+			pending = self.pending
+			self.pending = deque()
+		for result in pending:
+			result.set(error="Worker process ended")
+
+	def stop(self):
+		with self.mutex:
+			process = self.process
+			self.process = None
+		if process is not None:
+			self.messages.put(None)
+			try:
+				process.kill()
+				process.wait()
+			except Exception:
+				pass
+
+	def alive(self):
+		return self.process is not None
+
+
+class ParserPool:
+	"""Worker processes that convert the chunks of splitProgrammes. They run
+	WORKER_SCRIPT in a new interpreter, so they share no memory, locks or
+	descriptors with enigma2. An import keeps one pool for all its sources,
+	the processes are started when the first source needs them."""
+
+	def __init__(self, workers):
+		self.workers = workers
+		self.processes = []
+		self.next = 0
+
+	def start(self):
+		self.processes = [process for process in self.processes if process.alive()]
+		if len(self.processes) >= self.workers:
+			return
+		python = workerPython()
+		if python is None:
+			raise Exception("No Python interpreter for the worker processes")
+		while len(self.processes) < self.workers:
+			self.processes.append(WorkerProcess(python))
+
+	def setup(self, *args):
+		"""Passes the arguments of initWorker for the next chunks"""
+		for process in self.processes:
+			process.send(("setup", args))
+
+	def apply_async(self, chunk):
+		"""Returns the WorkerResult of convertChunk(chunk)"""
+		result = WorkerResult()
+		process = self.processes[self.next % len(self.processes)]
+		self.next += 1
+		process.send(("chunk", chunk), result)
+		return result
+
+	def terminate(self):
+		for process in self.processes:
+			process.stop()
+		self.processes = []
+
+
 class XMLTVConverter:
-	def __init__(self, channels_dict, category_dict, dateformat="%Y%m%d%H%M%S %Z", offset=0):
+	def __init__(self, channels_dict, category_dict, dateformat="%Y%m%d%H%M%S %Z", offset=0, backend="etree", languages=("nl",), workers=1, windowStart=None, windowEnd=None, pool=None):
 		self.channels = channels_dict
 		self.categories = category_dict
+		self.dateformat = dateformat
+		self.languages = languages
+		self.workers = workers
+		# the ParserPool of the import, without one a pool is started per file
+		self.pool = pool
+		# only events that end after windowStart and start before windowEnd
+		self.windowStart = windowStart
+		self.windowEnd = windowEnd
 		if dateformat.startswith("%Y%m%d%H%M%S"):
 			self.dateParser = quickptime
 		else:
 			self.dateParser = lambda x: strptime(x, dateformat)
 		self.offset = offset
+		self.backend = backend
+		self.languageRanks = languageRanks(languages)
+		self.lastUnknown = None
 		print("[XMLTVConverter] Using a custom time offset of %d" % offset)
 
 	def enumFile(self, fileobj):
 		print("[XMLTVConverter] Enumerating event information", file=log)
-		lastUnknown = None
+		self.lastUnknown = None
 		# there is nothing no enumerate if there are no channels loaded
 		if not self.channels:
 			return
+		pool = self.pool
+		if pool is None and self.workers > 1:
+			pool = ParserPool(self.workers)
+		if pool is not None:
+			head, fileobj = readHead(fileobj)
+			if hasInternalSubset(head):
+				print("[XMLTVConverter] The DOCTYPE defines entities, parsing in this process", file=log)
+				pool = None
+		if pool is not None:
+			try:
+				pool.start()
+				pool.setup(list(self.channels), self.categories, self.dateformat, self.offset, self.backend, self.languages, self.windowStart, self.windowEnd)
+			except Exception as e:
+				print("[XMLTVConverter] Parallel parsing not available:", e, file=log)
+				pool.terminate()
+				pool = None
+		if pool is not None:
+			print("[XMLTVConverter] Parsing with %d processes" % pool.workers, file=log)
+			try:
+				for r in self.enumParallel(fileobj, pool):
+					yield r
+			finally:
+				if pool is not self.pool:
+					pool.terminate()
+			return
+		for r in self.enumSerial(fileobj):
+			yield r
+
+	def enumParallel(self, fileobj, pool):
+		"""Converts the chunks of fileobj in the worker processes of pool and
+		yields the events in document order. Only a few chunks are in flight
+		at any time, so memory use does not depend on the file size. When a
+		worker fails or does not answer within PARALLEL_TIMEOUT, the chunks
+		that are left are converted in this process."""
+		channels = self.channels
+		chunks = splitProgrammes(fileobj)
+		pending = deque()
+		more = True
+		deadline = time() + PARALLEL_TIMEOUT
+		while more or pending:
+			while more and len(pending) < 2 * pool.workers:
+				chunk = next(chunks, None)
+				if chunk is None:
+					more = False
+				else:
+					pending.append((chunk, pool.apply_async(chunk)))
+			if not pending:
+				return
+			result = pending[0][1]
+			result.wait(0.1)
+			if not result.ready():
+				if time() < deadline:
+					# give up time to the reactor
+					yield None
+					continue
+				print("[XMLTVConverter] Worker processes do not answer", file=log)
+				break
+			try:
+				events = result.get()
+			except Exception as e:
+				print("[XMLTVConverter] Worker process failed:", e, file=log)
+				break
+			pending.popleft()
+			deadline = time() + PARALLEL_TIMEOUT
+			for channel, event in events:
+				yield (channels[channel], event)
+		if not pending:
+			return
+		pool.terminate()
+		print("[XMLTVConverter] Parsing the rest of the file in this process", file=log)
+		for chunk, result in pending:
+			for r in self.enumSerial(BytesIO(chunk)):
+				yield r
+		for chunk in chunks:
+			for r in self.enumSerial(BytesIO(chunk)):
+				yield r
+
+	def enumSerial(self, fileobj):
+		window = None
+		if self.windowStart is not None or self.windowEnd is not None:
+			window = self.inWindow
+		if self.backend == "expat":
+			print("[XMLTVConverter] Using the expat parser", file=log)
+			for programme in enumerateMappedProgrammes(fileobj, self.channels, self.unknownChannel, self.languageRanks, window):
+				if programme is None:
+					yield None
+					continue
+				services, elem = programme
+				event = self.convertProgramme(elem)
+				if event is not None:
+					yield (services, event)
+			return
 		for elem in enumerateProgrammes(fileobj):
 			channel = elem.get("channel")
 			channel = channel.lower()
 			if channel not in self.channels:
-				if lastUnknown != channel:
-					print("Unknown channel: ", channel, file=log)
-					lastUnknown = channel
+				self.unknownChannel(channel)
 				# return a None object to give up time to the reactor.
 				yield None
 				continue
+			if window is not None and not window(elem.get("start"), elem.get("stop")):
+				yield None
+				continue
+			event = self.convertProgramme(elem)
+			if event is not None:
+				yield (self.channels[channel], event)
+
+	def inWindow(self, start, stop):
+		"""Checks the start and stop attributes of a programme against the
+		import window, before anything else of the programme is converted"""
+		if self.windowStart is not None and get_time_utc(stop, self.dateParser) + self.offset <= self.windowStart:
+			return False
+		if self.windowEnd is not None and get_time_utc(start, self.dateParser) + self.offset >= self.windowEnd:
+			return False
+		return True
+
+	def unknownChannel(self, channel):
+		if self.lastUnknown != channel:
+			print("Unknown channel: ", channel, file=log)
+			self.lastUnknown = channel
+
+	def convertProgramme(self, elem):
+		"""Converts a programme element into an event tuple, None on errors"""
+		try:
+			start = get_time_utc(elem.get("start"), self.dateParser) + self.offset
+			stop = get_time_utc(elem.get("stop"), self.dateParser) + self.offset
+			texts, rating_str = get_xml_texts(elem, self.languageRanks)
+			title = decode_entities(texts.get("title", ""))
+			# try/except for EPG XML files with program entries containing <sub-title ... />
 			try:
-				services = self.channels[channel]
-				start = get_time_utc(elem.get("start"), self.dateParser) + self.offset
-				stop = get_time_utc(elem.get("stop"), self.dateParser) + self.offset
-				title = get_xml_string(elem, "title")
-				# try/except for EPG XML files with program entries containing <sub-title ... />
-				try:
-					subtitle = get_xml_string(elem, "sub-title")
-				except:
-					subtitle = ""
-				# try/except for EPG XML files with program entries containing <desc ... />
-				try:
-					description = get_xml_string(elem, "desc")
-				except:
-					description = ""
-				category = get_xml_string(elem, "category")
-				cat_nr = self.get_category(category, stop - start)
-
-				try:
-					rating_str = get_xml_rating_string(elem)
-					# hardcode country as ENG since there is no handling for parental certification systems per country yet
-					# also we support currently only number like values like "12+" since the epgcache works only with bytes right now
-					rating = [("eng", int(rating_str) - 3)]
-				except:
-					rating = None
-
-				# data_tuple = (data.start, data.duration, data.title, data.short_description, data.long_description, data.type)
-				if not stop or not start or (stop <= start):
-					print("[XMLTVConverter] Bad start/stop time: %s (%s) - %s (%s) [%s]" % (elem.get('start'), start, elem.get('stop'), stop, title))
-				if rating:
-					yield (services, (start, stop - start, title, subtitle, description, cat_nr, 0, rating))
-				else:
-					yield (services, (start, stop - start, title, subtitle, description, cat_nr))
-			except Exception as e:
-				print("[XMLTVConverter] parsing event error:", e)
+				subtitle = decode_entities(texts.get("sub-title", ""))
+			except:
+				subtitle = ""
+			# try/except for EPG XML files with program entries containing <desc ... />
+			try:
+				description = decode_entities(texts.get("desc", ""))
+			except:
+				description = ""
+			category = decode_entities(texts.get("category", ""))
+			cat_nr = self.get_category(category, stop - start)
+
+			try:
+				# hardcode country as ENG since there is no handling for parental certification systems per country yet
+				# also we support currently only number like values like "12+" since the epgcache works only with bytes right now
+				rating = [("eng", int(rating_str) - 3)]
+			except:
+				rating = None
+
+			# data_tuple = (data.start, data.duration, data.title, data.short_description, data.long_description, data.type)
+			if not stop or not start or (stop <= start):
+				print("[XMLTVConverter] Bad start/stop time: %s (%s) - %s (%s) [%s]" % (elem.get('start'), start, elem.get('stop'), stop, title))
+			if rating:
+				return (start, stop - start, title, subtitle, description, cat_nr, 0, rating)
+			else:
+				return (start, stop - start, title, subtitle, description, cat_nr)
+		except Exception as e:
+			print("[XMLTVConverter] parsing event error:", e)
 
 	def get_category(self, cat, duration):
 		if (not cat) or (not isinstance(cat, type("str"))):
@@ -0,0 +1,98 @@
+# Time conversion of the XMLTV importer
+#
+# Converts the start and stop attributes of XMLTV programmes to epoch
+# seconds. Kept free of enigma2 and plugin imports, so xmltvtime_check.py
+# can run it on its own.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+from calendar import timegm
+from time import struct_time
+
+
+def quickptime(date_str):
+	return struct_time(
+		(
+			int(date_str[0:4]),     # Year
+			int(date_str[4:6]),     # Month
+			int(date_str[6:8]),     # Day
+			int(date_str[8:10]),    # Hour
+			int(date_str[10:12]),   # Minute
+			0,                      # Second (set to 0)
+			-1,                     # Weekday (set to -1 as unknown)
+			-1,                     # Julian day (set to -1 as unknown)
+			0                       # DST (Daylight Saving Time, set to 0 as unknown)
+		)
+	)
+
+
+# Days before the first of every month in a non-leap year, index 1 is January
+DAYS_BEFORE_MONTH = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+# Limit for the memoized time strings, many events share start and stop times
+TIME_CACHE_SIZE = 20000
+timeCache = {}
+dayCache = {}
+offsetCache = {}
+
+
+def leapDays(year):
+	"""Number of leap days from 1970 up to the start of year"""
+	year -= 1
+	return year // 4 - year // 100 + year // 400 - 477
+
+
+def dayStart(date):
+	"""Epoch seconds of midnight UTC of the YYYYMMDD date prefix"""
+	seconds = dayCache.get(date)
+	if seconds is None:
+		year = int(date[0:4])
+		month = int(date[4:6])
+		if not 1 <= month <= 12:
+			raise ValueError("month %d out of range" % month)
+		days = (year - 1970) * 365 + leapDays(year) + DAYS_BEFORE_MONTH[month] + int(date[6:8]) - 1
+		if month > 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+			days += 1
+		seconds = dayCache[date] = days * 86400
+	return seconds
+
+
+def offsetSeconds(offset):
+	"""Seconds to subtract for a +HHMM offset, computed like the original code"""
+	seconds = offsetCache.get(offset)
+	if seconds is None:
+		seconds = offsetCache[offset] = 3600 * int(offset) // 100
+	return seconds
+
+
+def quick_time_utc(timestring):
+	"""get_time_utc for the YYYYMMDDhhmm[ss] +HHMM format. The seconds are
+	ignored, like quickptime does."""
+	result = timeCache.get(timestring)
+	if result is None:
+		stamp, offset = timestring.split(" ")[:2]
+		result = dayStart(stamp[0:8]) + int(stamp[8:10]) * 3600 + int(stamp[10:12]) * 60 - offsetSeconds(offset)
+		if len(timeCache) >= TIME_CACHE_SIZE:
+			timeCache.clear()
+		timeCache[timestring] = result
+	return result
+
+
+def get_time_utc(timestring, fdateparse):
+	# print("get_time_utc", timestring, format)
+	if fdateparse is quickptime:
+		try:
+			return quick_time_utc(timestring)
+		except Exception as e:
+			print("[XMLTVConverter] get_time_utc error:", e)
+			return 0
+	try:
+		values = timestring.split(" ")
+		tm = fdateparse(values[0])
+		time_gm = timegm(tm)
+		# suppose file says +0300 => that means we have to substract 3 hours from localtime to get GMT
+		time_gm -= (3600 * int(values[1]) // 100)
+		return time_gm
+	except Exception as e:
+		print("[XMLTVConverter] get_time_utc error:", e)
+		return 0
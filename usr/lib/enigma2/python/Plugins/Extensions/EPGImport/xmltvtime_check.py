@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# Checks quick_time_utc against the timegm based conversion it replaced and
+# compares their speed. Run it from this directory:
+#
+#	python xmltvtime_check.py
+
+from __future__ import print_function
+
+from calendar import timegm
+from timeit import timeit
+
+from xmltvtime import dayCache, get_time_utc, offsetCache, quick_time_utc, quickptime, timeCache
+
+
+def old_time_utc(timestring):
+	values = timestring.split(" ")
+	return timegm(quickptime(values[0])) - (3600 * int(values[1]) // 100)
+
+
+def main():
+	samples = []
+	for day in range(1, 29):
+		for month in (1, 2, 3, 6, 12):
+			for year in (1999, 2000, 2023, 2024, 2100):
+				for hour in (0, 7, 23):
+					for offset in ("+0000", "+0100", "-0500", "+0530", "+1300"):
+						samples.append("%04d%02d%02d%02d3045 %s" % (year, month, day, hour, offset))
+	for sample in samples:
+		assert quick_time_utc(sample) == old_time_utc(sample), sample
+	print("%d time strings converted identically" % len(samples))
+	# a week of half hour slots, every one used as start and stop of many channels
+	week = ["202410%02d%02d%02d00 +0200" % (1 + i // 48, (i // 2) % 24, (i % 2) * 30) for i in range(7 * 48)] * 20
+	number = 20
+	old = timeit(lambda: [old_time_utc(x) for x in week], number=number)
+	timeCache.clear()
+	dayCache.clear()
+	offsetCache.clear()
+	new = timeit(lambda: [get_time_utc(x, quickptime) for x in week], number=number)
+	count = len(week) * number
+	print("timegm: %.2f us, cached: %.2f us per conversion" % (old * 1e6 / count, new * 1e6 / count))
+
+
+if __name__ == "__main__":
+	main()
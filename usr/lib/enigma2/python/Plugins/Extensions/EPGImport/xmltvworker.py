@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# Worker process of xmltvconverter.ParserPool
+#
+# Reads pickled messages from stdin: ("setup", arguments of initWorker) and
+# ("chunk", a document of splitProgrammes). Every chunk is answered on stdout
+# with (True, the result of convertChunk) or (False, the error).
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+from importlib import import_module
+from os.path import abspath, basename, dirname
+from pickle import dump, load, HIGHEST_PROTOCOL
+import sys
+import types
+
+
+def main():
+	stdin = getattr(sys.stdin, "buffer", sys.stdin)
+	stdout = getattr(sys.stdout, "buffer", sys.stdout)
+	directory = dirname(abspath(__file__))
+	if sys.path and abspath(sys.path[0]) == directory:
+		# the plugin modules are only imported through their package
+		del sys.path[0]
+	# The __init__ of the plugin package needs enigma2, which this process
+	# does not have. The converter only needs the package to exist.
+	name = basename(directory)
+	package = types.ModuleType(name)
+	package.__path__ = [directory]
+	sys.modules[name] = package
+	xmltvconverter = import_module(name + ".xmltvconverter")
+	error = "No setup"
+	while True:
+		try:
+			kind, value = load(stdin)
+		except EOFError:
+			break
+		if kind == "setup":
+			try:
+				xmltvconverter.initWorker(*value)
+				error = None
+			except Exception as e:
+				error = repr(e)
+			continue
+		if error is not None:
+			answer = (False, error)
+		else:
+			try:
+				answer = (True, xmltvconverter.convertChunk(value))
+			except Exception as e:
+				answer = (False, repr(e))
+		dump(answer, stdout, HIGHEST_PROTOCOL)
+		stdout.flush()
+
+
+if __name__ == "__main__":
+	main()